@@ -0,0 +1,223 @@
+"""
+Incremental PNG reader
+
+PngRowReader takes a PNG file in pieces and hands back its scanlines,
+inflated and unfiltered, one at a time.  Only as much of the image data
+as the caller asks for is ever inflated, so someone who needs the first
+rows of a large image pays for those rows alone.
+
+Only non interlaced 8 bit RGB and RGBA images are read, which is what
+PIL writes for the carriers the client uses.  Anything else raises
+UnsupportedPng and the caller should fall back to a full decoder.
+"""
+import struct, zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# color type -> (PIL mode, colors per pixel)
+COLOR_TYPES = {2: ('RGB', 3), 6: ('RGBA', 4)}
+
+# Compressed image data handed to zlib at a time
+INFLATE_CHUNK = 16384
+
+# Largest chunk other than IDAT we are willing to buffer
+MAX_CHUNK = 1 << 20
+
+_CHUNK_HEAD = struct.Struct('>I4s')
+_IHDR = struct.Struct('>IIBBBBB')
+
+class PngStreamError(Exception):
+    '''
+    The data is not a well formed PNG file
+    '''
+    pass
+
+class UnsupportedPng(PngStreamError):
+    '''
+    A well formed PNG file in a format PngRowReader does not read
+    '''
+    pass
+
+class PngRowReader(object):
+    '''
+    Feed the file content in order with feed(), then iterate rows() for
+    the scanlines that can be decoded so far.  Errors in the signature or
+    the header are raised by the very feed() that brings them in.
+    '''
+    def __init__(self):
+        self.width = self.height = None
+        self.mode = None
+        self.bands = None
+        self.row = 0
+        self.ended = False
+        self._buf = bytearray()
+        self._signed = False
+        # (type, bytes left, running crc) of an IDAT chunk being read
+        self._idat = None
+        self._zin = bytearray()
+        self._zpos = 0
+        self._inflater = zlib.decompressobj()
+        self._pending = bytearray()
+        self._prev = None
+
+    def feed(self, data):
+        if self.ended:
+            return
+        self._buf += data
+        if not self._signed:
+            if not PNG_SIGNATURE.startswith(bytes(self._buf[:len(PNG_SIGNATURE)])):
+                raise PngStreamError("Not a PNG file")
+            if len(self._buf) < len(PNG_SIGNATURE):
+                return
+            del self._buf[:len(PNG_SIGNATURE)]
+            self._signed = True
+        while not self.ended and self._next_chunk():
+            pass
+
+    @property
+    def nbytes(self):
+        '''
+        Bytes held in the reader's buffers
+        '''
+        return len(self._buf) + len(self._zin) + len(self._pending) + len(self._prev or b'')
+
+    def rows(self):
+        '''
+        Yields each scanline, unfiltered, as soon as enough image data is
+        in for it
+        '''
+        while self.height is not None and self.row < self.height:
+            line = self._inflate(self._stride + 1)
+            if line is None:
+                return
+            if self._prev is None:
+                # the row above the first one, only made once a row is in
+                # so a header alone costs nothing whatever its width
+                self._prev = bytearray(self._stride)
+            self._unfilter(line[0], line, self._prev)
+            del line[0]
+            self._prev = line
+            self.row += 1
+            yield bytes(line)
+
+    def _next_chunk(self):
+        '''
+        Consumes what it can of the next chunk, returns False when more
+        data is needed
+        '''
+        buf = self._buf
+        if self._idat is not None:
+            ctype, left, crc = self._idat
+            if left:
+                body = bytes(buf[:left])
+                del buf[:len(body)]
+                self._zin += body
+                self._idat = ctype, left - len(body), zlib.crc32(body, crc)
+                return len(body) == left
+            if len(buf) < 4:
+                return False
+            self._check_crc(crc, buf[:4])
+            del buf[:4]
+            self._idat = None
+            return True
+
+        if len(buf) < _CHUNK_HEAD.size:
+            return False
+        length, ctype = _CHUNK_HEAD.unpack(bytes(buf[:_CHUNK_HEAD.size]))
+        if self.width is None and ctype != b'IHDR':
+            raise PngStreamError("PNG file does not start with IHDR")
+        if ctype == b'IDAT':
+            del buf[:_CHUNK_HEAD.size]
+            self._idat = ctype, length, zlib.crc32(ctype)
+            return True
+        if length > MAX_CHUNK:
+            raise PngStreamError("%r chunk of %d bytes" % (ctype, length))
+        end = _CHUNK_HEAD.size + length
+        if len(buf) < end + 4:
+            return False
+        body = bytes(buf[_CHUNK_HEAD.size:end])
+        self._check_crc(zlib.crc32(body, zlib.crc32(ctype)), buf[end:end + 4])
+        del buf[:end + 4]
+        if ctype == b'IHDR':
+            self._header(body)
+        elif ctype == b'IEND':
+            self.ended = True
+        return True
+
+    def _check_crc(self, crc, stored):
+        if crc & 0xffffffff != struct.unpack('>I', bytes(stored))[0]:
+            raise PngStreamError("PNG chunk checksum mismatch")
+
+    def _header(self, body):
+        if self.width is not None or len(body) != _IHDR.size:
+            raise PngStreamError("Bad IHDR chunk")
+        width, height, depth, ctype, compression, filter_method, interlace = _IHDR.unpack(body)
+        if not width or not height or compression or filter_method or interlace > 1:
+            raise PngStreamError("Bad IHDR chunk")
+        if depth != 8 or ctype not in COLOR_TYPES or interlace:
+            raise UnsupportedPng("bit depth %d, color type %d, interlace %d" % (depth, ctype, interlace))
+        self.width, self.height = width, height
+        self.mode, self.bands = COLOR_TYPES[ctype]
+        self._stride = width * self.bands
+
+    def _inflate(self, n):
+        '''
+        Returns the next n bytes of inflated image data as a bytearray, or
+        None if they are not all in yet
+        '''
+        while len(self._pending) < n and self._zpos < len(self._zin):
+            data = bytes(self._zin[self._zpos:self._zpos + INFLATE_CHUNK])
+            try:
+                out = self._inflater.decompress(data, n - len(self._pending))
+            except zlib.error as e:
+                raise PngStreamError(str(e))
+            used = len(data) - len(self._inflater.unconsumed_tail)
+            if not out and not used:
+                break
+            self._pending += out
+            self._zpos += used
+        if self._zpos > INFLATE_CHUNK:
+            del self._zin[:self._zpos]
+            self._zpos = 0
+        if len(self._pending) < n:
+            return None
+        line = self._pending[:n]
+        del self._pending[:n]
+        return line
+
+    def _unfilter(self, ftype, line, prev):
+        '''
+        Undoes the filter of line in place, line[0] being the filter byte
+        '''
+        bpp = self.bands
+        n = len(line)
+        if ftype == 0:
+            return
+        elif ftype == 1:
+            for i in xrange(1 + bpp, n):
+                line[i] = (line[i] + line[i - bpp]) & 0xFF
+        elif ftype == 2:
+            for i in xrange(1, n):
+                line[i] = (line[i] + prev[i - 1]) & 0xFF
+        elif ftype == 3:
+            for i in xrange(1, n):
+                left = line[i - bpp] if i > bpp else 0
+                line[i] = (line[i] + ((left + prev[i - 1]) >> 1)) & 0xFF
+        elif ftype == 4:
+            for i in xrange(1, n):
+                if i > bpp:
+                    a, c = line[i - bpp], prev[i - 1 - bpp]
+                else:
+                    a = c = 0
+                b = prev[i - 1]
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    pred = a
+                elif pb <= pc:
+                    pred = b
+                else:
+                    pred = c
+                line[i] = (line[i] + pred) & 0xFF
+        else:
+            raise PngStreamError("Bad filter type %d" % ftype)
@@ -1,185 +1,577 @@
-'''
-Copyright (C) 2010 Zachary Varberg
-@author: Zachary Varberg
-
-This file is part of Steganogra-py.
-
-Steganogra-py is free software: you can redistribute it and/or modify
-it under the terms of the GNU General Public License as published by
-the Free Software Foundation, either version 3 of the License, or
-(at your option) any later version.
-
-Steganogra-py is distributed in the hope that it will be useful,
-but WITHOUT ANY WARRANTY; without even the implied warranty of
-MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-GNU General Public License for more details.
-
-You should have received a copy of the GNU General Public License
-along with Steganogra-py.  If not, see <http://www.gnu.org/licenses/>.
-'''
-import Image
-
-class FileTooLargeException(Exception):
-    '''
-    Custom Exception to throw if the file is too large to fit in 
-    the Image file specified
-    ''' 
-    pass
-
-
-def Dec2Bin(n):
-    '''
-    Function to convert an integer to a string of 1s and 0s that is the
-    binary equivalent.  Code inspired from 
-    http://www.daniweb.com/code/snippet216539.html
-    '''
-    return "".join([str((n>>y)&1) for y in xrange(7,-1,-1)])
-
-def Bin2Dec(n):
-    '''
-    Function that takes a string of 1s and 0s and converts it back to an
-    integer
-    '''
-    tmp = 0
-    for i in xrange(1,len(n)+1):
-        tmp+= (pow(2,i-1))*int(n[-i])
-    return tmp
-
-def encode(im_file, data_file, red_bits=1, green_bits=1, blue_bits=1):
-    ''' 
-    im_file is a string that is the file name of the image to 
-    encode the data into.  The data comes from data_file (which is a file object or a StringIO).  Currently
-    only character data is supported.  The red, green, and blue bits
-    variables determine how many bits of each color to encode the data
-    into.
-    '''
-    in_image = Image.open(im_file,'r')
-    data = ""
-    for line in data_file:
-        for char in line:
-            data += Dec2Bin(ord(char))
-    # Termination characters
-    data+= Dec2Bin(255) + Dec2Bin(255)
-    
-    new_image_data = []
-    colors = ["red", "green", "blue"]
-    i = 0;
-    curCol = 0;
-    for pixel in in_image.getdata():
-        # This will hold the new array of R,G,B colors with the 
-        # embedded data
-        new_col_arr = []
-        for color in pixel:
-            new_col = 0
-            # if we still have data to encode
-            if(i < len(data)):
-                
-                # Number of bits to encode for this color
-                bits = 1
-                if (colors[curCol%3]=="red"):
-                    bits = red_bits
-                elif (colors[curCol%3]=="green"):
-                    bits = green_bits
-                elif (colors[curCol%3]=="blue"):
-                    bits = blue_bits
-
-                # Encode the number of bits requested
-                tmp = list(Dec2Bin(color))
-                for j in xrange(1,bits+1):
-                    # if we still have data to encode
-                    if(i < len(data)):
-                        tmp[-j]=data[i]
-                        i+=1
-                
-                #Pull out a new int value for the encoded color
-                new_col = Bin2Dec("".join(tmp))
-            else:
-                new_col = color
-            
-            # Append the new color to our new pixel array
-            new_col_arr.append(new_col)
-            curCol +=1
-        
-        # Append the new 3 color array to our new image data
-        new_image_data.append(new_col_arr)
-    
-    # If there wasn't enough pixels to encode all the data.
-    if i != len(data):
-        raise FileTooLargeException("Image to small for current settings.")
-
-    # Write our new image data to a new image
-    out_image = in_image.copy()
-    for x in xrange(out_image.size[0]):
-        for y in xrange(out_image.size[1]):
-            pos = x + out_image.size[0] * y
-            out_image.putpixel((x,y),tuple(new_image_data[pos]))
-    return out_image
-    
-def decode(im_dec, red_bits=1, green_bits=1, blue_bits=1):
-    in_image = Image.open(im_dec)
-
-    # Number of consecutive ones to track if we've found the termination
-    # characters
-    num_ones = 0
-    
-    # The data pulled out
-    data = []
-    
-    tmp_list = []
-    colors = ["red", "green", "blue"]
-    try:
-        for pixel in in_image.getdata():
-            i = 0
-            for color in pixel:
-                tmp = list(Dec2Bin(color))
-                
-                bits = 1
-                if(colors[i%3]=="red"):
-                    bits = red_bits
-                if(colors[i%3]=="green"):
-                    bits = green_bits
-                if(colors[i%3]=="blue"):
-                    bits = blue_bits
-
-                # Pull out the specified number of bits based on the color
-                for j in xrange(1,bits+1):
-                    tmp_list.append(tmp[-j])
-                    if tmp[-j] == '1':
-                        num_ones += 1
-                    else:
-                        num_ones = 0
-                    # If we have pulled out 1 byte of data
-                    if len(tmp_list) == 8:
-                        data.append(tmp_list)
-                        tmp_list = []
-                    # Two 255 characters is a termination sequence
-                    if num_ones == 16:
-                        raise StopIteration
-                i += 1
-                
-    except StopIteration:
-        pass
-    
-    
-    chars = ""
-    for char in data[:-1]:
-        tmp = chr(Bin2Dec("".join(char)))
-        if(ord(tmp)!=255):
-            chars+=tmp
-        
-    return chars
-
-def save_file(data, file_name):
-    '''
-    This will write all of the information in data (currently only
-    character data is tested) and save it to the file file_name
-    '''
-    out_file = open(file_name,'wb+')
-    out_file.write(data)
-    out_file.close()
-
-if __name__ == '__main__':
-    pass
-#    encode('flower.png','Macbeth.txt',0,1,6).save('newOut.png')
-#    save_file(decode('newOut.png',0,1,6),'newOut1.txt')
-
+'''
+Copyright (C) 2010 Zachary Varberg
+@author: Zachary Varberg
+
+This file is part of Steganogra-py.
+
+Steganogra-py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Steganogra-py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Steganogra-py.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import struct, zlib
+import StringIO
+
+import Image
+import PngStream
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Image modes whose raw data is 8 bit colors, pixel after pixel.  The
+# fast paths work on these, anything else goes the slow way
+BUFFER_MODES = ('RGB', 'RGBA')
+
+# Pixels pulled out of the image at a time while decoding
+DECODE_PIXELS = 4096
+
+# Framed data starts with a header instead of ending with the termination
+# characters: magic, version, data length and crc32 of the data.  A 0xFF
+# magic never starts unframed data since decode drops every 0xFF from it.
+FRAME_HEADER = struct.Struct('>BBHI')
+FRAME_MAGIC = 0xFF
+FRAME_VERSION = 1
+
+# Rows up to this many pixels wide are read whatever max_bytes is, wider
+# ones only as far as the data max_bytes allows can reach
+MIN_ROW_PIXELS = 4096
+
+# PIL calls these tostring/fromstring, Pillow tobytes/frombytes
+_frombytes = getattr(Image, 'frombytes', None) or Image.fromstring
+
+def _tobytes(im):
+    return im.tobytes() if hasattr(im, 'tobytes') else im.tostring()
+
+class FileTooLargeException(Exception):
+    '''
+    Custom Exception to throw if the file is too large to fit in 
+    the Image file specified
+    ''' 
+    pass
+
+class StegoFormatError(Exception):
+    '''
+    Raised when the data pulled out of an image is not in the expected
+    format
+    '''
+    pass
+
+
+def Dec2Bin(n):
+    '''
+    Function to convert an integer to a string of 1s and 0s that is the
+    binary equivalent.  Code inspired from 
+    http://www.daniweb.com/code/snippet216539.html
+    '''
+    return "".join([str((n>>y)&1) for y in xrange(7,-1,-1)])
+
+def Bin2Dec(n):
+    '''
+    Function that takes a string of 1s and 0s and converts it back to an
+    integer
+    '''
+    tmp = 0
+    for i in xrange(1,len(n)+1):
+        tmp+= (pow(2,i-1))*int(n[-i])
+    return tmp
+
+def encode(im_file, data_file, red_bits=1, green_bits=1, blue_bits=1, framed=False):
+    ''' 
+    im_file is a string that is the file name of the image to 
+    encode the data into.  The data comes from data_file (which is a file object or a StringIO).  Currently
+    only character data is supported.  The red, green, and blue bits
+    variables determine how many bits of each color to encode the data
+    into.  With framed set the data goes after a header (see FRAME_HEADER)
+    instead of before the termination characters.
+    '''
+    in_image = Image.open(im_file,'r')
+    data = "".join(data_file)
+    if framed:
+        if in_image.mode not in BUFFER_MODES:
+            raise StegoFormatError("Framed data needs an RGB or RGBA image")
+        if len(data) > 0xFFFF:
+            raise FileTooLargeException("Data too large for a frame.")
+        data = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, len(data), zlib.crc32(data) & 0xffffffff) + data
+        pattern = _pixel_pattern(len(in_image.getbands()), red_bits, green_bits, blue_bits)
+    else:
+        # Termination characters
+        data += chr(255) + chr(255)
+        if in_image.mode not in BUFFER_MODES:
+            return _encode_python(in_image, data, red_bits, green_bits, blue_bits)
+        # Colors are numbered across the image (not per pixel) and color k
+        # carries the bits of pattern[k%3], lowest bit first
+        pattern = (red_bits, green_bits, blue_bits)
+
+    n = _colors_needed(len(data) * 8, pattern)
+    width, height = in_image.size
+    row = width * len(in_image.getbands())
+    if n > row * height:
+        raise FileTooLargeException("Image to small for current settings.")
+
+    # Only the leading rows holding the data are pulled out and put back
+    out_image = in_image.copy()
+    box = (0, 0, width, -(-n // row))
+    colors = bytearray(_tobytes(out_image.crop(box)))
+    if numpy is not None:
+        _embed_numpy(colors, data, pattern, n)
+    else:
+        _embed_python(colors, data, pattern, n)
+    out_image.paste(_frombytes(out_image.mode, box[2:], bytes(colors)), box)
+    return out_image
+
+def _colors_needed(nbits, pattern):
+    '''
+    Number of leading colors that hold nbits of data with the given
+    bits per color pattern
+    '''
+    per_pixel = sum(pattern)
+    if per_pixel == 0:
+        raise FileTooLargeException("Image to small for current settings.")
+    n = nbits // per_pixel * len(pattern)
+    left = nbits % per_pixel
+    for bits in pattern:
+        if left <= 0:
+            break
+        n += 1
+        left -= bits
+    return n
+
+def _embed_numpy(colors, data, pattern, n):
+    '''
+    Writes data into the first n colors of the bytearray colors, one
+    pass per bit plane with at most 8 of them
+    '''
+    colors = numpy.frombuffer(colors, dtype=numpy.uint8)
+    data = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))
+    bits = numpy.resize(numpy.array(pattern, dtype=numpy.intp), n)
+    offsets = numpy.cumsum(bits) - bits
+    for j in xrange(max(pattern)):
+        sel = numpy.nonzero((bits > j) & (offsets + j < len(data)))[0]
+        if not len(sel):
+            break
+        colors[sel] = (colors[sel] & (0xFF ^ (1 << j))) | (data[offsets[sel] + j] << j)
+
+def _embed_python(colors, data, pattern, n):
+    '''
+    Same as _embed_numpy, one bit at a time
+    '''
+    i = 0
+    for k in xrange(n):
+        for j in xrange(pattern[k % len(pattern)]):
+            if i == len(data) * 8:
+                return
+            bit = (ord(data[i >> 3]) >> (7 - (i & 7))) & 1
+            colors[k] = (colors[k] & (0xFF ^ (1 << j))) | (bit << j)
+            i += 1
+
+def _encode_python(in_image, data, red_bits, green_bits, blue_bits):
+    '''
+    Slow path for image modes that have no plain color buffer
+    '''
+    data = "".join([Dec2Bin(ord(char)) for char in data])
+
+    new_image_data = []
+    colors = ["red", "green", "blue"]
+    i = 0;
+    curCol = 0;
+    for pixel in in_image.getdata():
+        # This will hold the new array of R,G,B colors with the 
+        # embedded data
+        new_col_arr = []
+        for color in pixel:
+            new_col = 0
+            # if we still have data to encode
+            if(i < len(data)):
+                
+                # Number of bits to encode for this color
+                bits = 1
+                if (colors[curCol%3]=="red"):
+                    bits = red_bits
+                elif (colors[curCol%3]=="green"):
+                    bits = green_bits
+                elif (colors[curCol%3]=="blue"):
+                    bits = blue_bits
+
+                # Encode the number of bits requested
+                tmp = list(Dec2Bin(color))
+                for j in xrange(1,bits+1):
+                    # if we still have data to encode
+                    if(i < len(data)):
+                        tmp[-j]=data[i]
+                        i+=1
+                
+                #Pull out a new int value for the encoded color
+                new_col = Bin2Dec("".join(tmp))
+            else:
+                new_col = color
+            
+            # Append the new color to our new pixel array
+            new_col_arr.append(new_col)
+            curCol +=1
+        
+        # Append the new 3 color array to our new image data
+        new_image_data.append(new_col_arr)
+    
+    # If there wasn't enough pixels to encode all the data.
+    if i != len(data):
+        raise FileTooLargeException("Image to small for current settings.")
+
+    # Write our new image data to a new image
+    out_image = in_image.copy()
+    for x in xrange(out_image.size[0]):
+        for y in xrange(out_image.size[1]):
+            pos = x + out_image.size[0] * y
+            out_image.putpixel((x,y),tuple(new_image_data[pos]))
+    return out_image
+    
+def decode(im_dec, red_bits=1, green_bits=1, blue_bits=1, legacy=True, max_bytes=None):
+    '''
+    Pulls the data out of the image file im_dec.  Framed data is found by
+    its header, anything else is read up to the termination characters
+    unless legacy is False, in which case StegoFormatError is raised.
+    So is data longer than max_bytes, when given.
+    '''
+    in_image = Image.open(im_dec)
+    if in_image.mode not in BUFFER_MODES:
+        if not legacy:
+            raise StegoFormatError("No framed data in a %s image" % in_image.mode)
+        return _decode_python(in_image, red_bits, green_bits, blue_bits)
+
+    width, height = in_image.size
+    pattern = _pixel_pattern(len(in_image.getbands()), red_bits, green_bits, blue_bits)
+    reader = PayloadReader(pattern, width * height, legacy, max_bytes)
+    # A few rows at a time, so that we stop as soon as the data is out
+    step = max(1, DECODE_PIXELS // width)
+    for y in xrange(0, height, step):
+        if reader.feed(_tobytes(in_image.crop((0, y, width, min(y + step, height))))):
+            break
+    return reader.finish()
+
+def decode_png(png, red_bits=1, green_bits=1, blue_bits=1, legacy=True, max_bytes=None):
+    '''
+    Same as decode for the PNG file content png, but only the rows that
+    hold the data are ever inflated and unfiltered.  PNG formats the row
+    reader does not handle go through decode.
+    '''
+    decoder = PngPayloadDecoder(red_bits, green_bits, blue_bits, legacy, max_bytes)
+    decoder.feed(png)
+    return decoder.finish()
+
+class PngPayloadDecoder(object):
+    '''
+    decode_png for a PNG file that comes in pieces.  Each piece given to
+    feed() is decoded as far as it goes and feed() returns True once the
+    data is out.  A bad signature or header, or rows wider than max_bytes
+    of data can need, raises StegoFormatError from the feed() that brings
+    it in.  size_hint is the expected file size.
+    '''
+    def __init__(self, red_bits=1, green_bits=1, blue_bits=1, legacy=True, max_bytes=None, size_hint=0):
+        self._bits = (red_bits, green_bits, blue_bits)
+        self._legacy = legacy
+        self._max_bytes = max_bytes
+        self._size_hint = size_hint
+        self._rows = PngStream.PngRowReader()
+        self._reader = None
+        # What came in before the header was read
+        self._head = bytearray()
+        # The whole file, kept only when the row reader can not read it
+        self._raw = None
+        self._rawlen = 0
+
+    def feed(self, data):
+        if self._raw is not None:
+            self._keep(data)
+            return False
+        if self._reader is not None and self._reader.done:
+            return True
+        try:
+            if self._reader is None:
+                self._head += data
+            self._rows.feed(data)
+            if self._reader is None:
+                if self._rows.width is None:
+                    return False
+                self._head = None
+                pattern = _pixel_pattern(self._rows.bands, *self._bits)
+                self._check_width(sum(pattern))
+                self._reader = PayloadReader(pattern, self._rows.width * self._rows.height, self._legacy, self._max_bytes)
+            for row in self._rows.rows():
+                if self._reader.feed(row):
+                    return True
+        except PngStream.UnsupportedPng:
+            self._raw = bytearray(max(self._size_hint, len(self._head)))
+            self._keep(self._head)
+            self._head = None
+        except PngStream.PngStreamError as e:
+            raise StegoFormatError(str(e))
+        return False
+
+    @property
+    def nbytes(self):
+        '''
+        Bytes held in the decoder's buffers, whatever part of them is used
+        '''
+        if self._raw is not None:
+            return len(self._raw)
+        n = self._rows.nbytes + len(self._head or b'')
+        if self._reader is not None:
+            n += self._reader.nbytes
+        return n
+
+    def finish(self):
+        '''
+        Returns the data once feed() said so or the file is all in
+        '''
+        if self._raw is not None:
+            png = StringIO.StringIO(bytes(self._raw[:self._rawlen]))
+            return decode(png, self._bits[0], self._bits[1], self._bits[2], self._legacy, self._max_bytes)
+        if self._reader is None or (not self._reader.done and self._rows.row < self._rows.height):
+            raise StegoFormatError("PNG file cut short")
+        return self._reader.finish()
+
+    def _check_width(self, bits):
+        '''
+        A row is inflated whole before any of it is read, so a row wider
+        than max_bytes of data can span is refused before it is inflated
+        '''
+        if self._max_bytes is None or not bits:
+            return
+        # the data with its frame header, or with the terminator and the
+        # byte the bit by bit decoder drops
+        need = (self._max_bytes + max(FRAME_HEADER.size, 3)) * 8
+        pixels = max((need + bits - 1) // bits, MIN_ROW_PIXELS)
+        if self._rows.width > pixels:
+            raise StegoFormatError("Rows of %d pixels are wider than %d bytes of data need" % (self._rows.width, self._max_bytes))
+
+    def _keep(self, data):
+        self._raw[self._rawlen:self._rawlen + len(data)] = data
+        self._rawlen += len(data)
+
+def _pixel_pattern(bands, red_bits, green_bits, blue_bits):
+    '''
+    Bits held by each color of a pixel when colors restart at red on
+    every pixel, which is how decode has always read them
+    '''
+    return [(red_bits, green_bits, blue_bits)[c % 3] for c in xrange(bands)]
+
+# Runs of 1s at each end of a byte, used to find the termination characters
+# in packed data
+_TRAILING_ONES = [len(Dec2Bin(i)) - len(Dec2Bin(i).rstrip('1')) for i in xrange(256)]
+_LEADING_ONES = [len(Dec2Bin(i)) - len(Dec2Bin(i).lstrip('1')) for i in xrange(256)]
+
+def _find_terminator(data, start=0):
+    '''
+    data is a bytearray of the bit stream packed into bytes.  Returns how
+    many whole bytes the bit by bit decoder would have pulled out when it
+    met 16 consecutive ones (or None) and where to resume the search once
+    more data is in.  Such a run always covers a full 0xFF byte, so only
+    the neighbours of each 0xFF need a closer look.
+    '''
+    q = data.find(b'\xff', start)
+    while q != -1:
+        if q + 1 == len(data):
+            return None, q
+        # ones carried over from the byte before (it is never 0xFF here)
+        t = q and _TRAILING_ONES[data[q-1]]
+        if _LEADING_ONES[data[q+1]] >= 8 - t:
+            return q + 1 + (8 - t) // 8, q
+        q = data.find(b'\xff', q + 2)
+    return None, len(data)
+
+class PayloadReader(object):
+    '''
+    Pulls the data out of colors fed to it in image order, whole pixels at
+    a time.  pattern holds the number of bits carried by each color of a
+    pixel and npixels, when known, bounds the data the image can hold.
+    feed() returns True as soon as the data is complete and raises
+    StegoFormatError as soon as it is known to be bad, which includes
+    going past max_bytes of data.
+    '''
+    def __init__(self, pattern, npixels=None, legacy=True, max_bytes=None):
+        self._pattern = list(pattern)
+        self._legacy = legacy
+        self._max_bytes = max_bytes
+        self._limit = None
+        if npixels is not None:
+            self._limit = npixels * sum(self._pattern) // 8
+        self._data = bytearray()
+        # Bits pulled out after the last whole byte
+        self._bits = []
+        self._framed = None
+        self._scan = 0
+        self._result = None
+
+    @property
+    def done(self):
+        return self._result is not None
+
+    @property
+    def nbytes(self):
+        return len(self._data)
+
+    def feed(self, colors):
+        if self._result is not None:
+            return True
+        if numpy is not None:
+            self._unpack_numpy(colors)
+        else:
+            self._unpack_python(colors)
+        return self._check()
+
+    def finish(self):
+        '''
+        Returns the data, to be called when feed() said so or when the
+        image has no more colors
+        '''
+        if self._result is not None:
+            return self._result
+        if self._framed:
+            raise StegoFormatError("Framed data cut short")
+        if not self._legacy:
+            raise StegoFormatError("No framed data found")
+        # The bit by bit decoder sees the last bits even if they do not
+        # make up a whole byte
+        data = self._data
+        if self._bits:
+            data = data + bytearray([sum(b << (7 - i) for i, b in enumerate(self._bits))])
+        end = _find_terminator(data, self._scan)[0]
+        if end is None:
+            end = len(self._data)
+        return bytes(self._data[:max(end - 1, 0)]).replace(b'\xff', b'')
+
+    def _unpack_numpy(self, colors):
+        pixels = numpy.frombuffer(colors, dtype=numpy.uint8).reshape(-1, len(self._pattern))
+        planes = [(pixels[:, c] >> j) & 1 for c, bits in enumerate(self._pattern) for j in xrange(bits)]
+        if not planes:
+            return
+        stream = numpy.column_stack(planes).reshape(-1)
+        if self._bits:
+            stream = numpy.concatenate((numpy.array(self._bits, dtype=numpy.uint8), stream))
+        whole = len(stream) // 8 * 8
+        self._data += numpy.packbits(stream[:whole]).tobytes()
+        self._bits = stream[whole:].tolist()
+
+    def _unpack_python(self, colors):
+        bits = self._bits
+        pattern = self._pattern
+        for k, color in enumerate(bytearray(colors)):
+            for j in xrange(pattern[k % len(pattern)]):
+                bits.append((color >> j) & 1)
+                if len(bits) == 8:
+                    self._data.append(sum(b << (7 - i) for i, b in enumerate(bits)))
+                    del bits[:]
+
+    def _check(self):
+        data = self._data
+        if self._framed is None:
+            if not data:
+                return False
+            self._framed = data[0] == FRAME_MAGIC
+            if not self._framed and not self._legacy:
+                raise StegoFormatError("No framed data found")
+        if not self._framed:
+            end, self._scan = _find_terminator(data, self._scan)
+            if end is None:
+                if self._max_bytes is not None and len(data) > self._max_bytes + 2:
+                    raise StegoFormatError("No termination characters in %d bytes" % self._max_bytes)
+                return False
+            self._result = bytes(data[:end - 1]).replace(b'\xff', b'')
+            return True
+
+        if len(data) < FRAME_HEADER.size:
+            return False
+        magic, version, length, crc = FRAME_HEADER.unpack(bytes(data[:FRAME_HEADER.size]))
+        if version != FRAME_VERSION:
+            raise StegoFormatError("Unknown frame version %d" % version)
+        end = FRAME_HEADER.size + length
+        if self._max_bytes is not None and length > self._max_bytes:
+            raise StegoFormatError("Frame of %d bytes is too long" % length)
+        if self._limit is not None and end > self._limit:
+            raise StegoFormatError("Frame of %d bytes does not fit the image" % length)
+        if len(data) < end:
+            return False
+        payload = bytes(data[FRAME_HEADER.size:end])
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            raise StegoFormatError("Framed data fails its checksum")
+        self._result = payload
+        return True
+
+def _decode_python(in_image, red_bits, green_bits, blue_bits):
+    '''
+    Pure python fallback for hosts without numpy or for unusual image modes
+    '''
+    # Number of consecutive ones to track if we've found the termination
+    # characters
+    num_ones = 0
+    
+    # The data pulled out
+    data = []
+    
+    tmp_list = []
+    colors = ["red", "green", "blue"]
+    try:
+        for pixel in in_image.getdata():
+            i = 0
+            for color in pixel:
+                tmp = list(Dec2Bin(color))
+                
+                bits = 1
+                if(colors[i%3]=="red"):
+                    bits = red_bits
+                if(colors[i%3]=="green"):
+                    bits = green_bits
+                if(colors[i%3]=="blue"):
+                    bits = blue_bits
+
+                # Pull out the specified number of bits based on the color
+                for j in xrange(1,bits+1):
+                    tmp_list.append(tmp[-j])
+                    if tmp[-j] == '1':
+                        num_ones += 1
+                    else:
+                        num_ones = 0
+                    # If we have pulled out 1 byte of data
+                    if len(tmp_list) == 8:
+                        data.append(tmp_list)
+                        tmp_list = []
+                    # Two 255 characters is a termination sequence
+                    if num_ones == 16:
+                        raise StopIteration
+                i += 1
+                
+    except StopIteration:
+        pass
+    
+    
+    chars = ""
+    for char in data[:-1]:
+        tmp = chr(Bin2Dec("".join(char)))
+        if(ord(tmp)!=255):
+            chars+=tmp
+        
+    return chars
+
+def save_file(data, file_name):
+    '''
+    This will write all of the information in data (currently only
+    character data is tested) and save it to the file file_name
+    '''
+    out_file = open(file_name,'wb+')
+    out_file.write(data)
+    out_file.close()
+
+if __name__ == '__main__':
+    pass
+#    encode('flower.png','Macbeth.txt',0,1,6).save('newOut.png')
+#    save_file(decode('newOut.png',0,1,6),'newOut1.txt')
+
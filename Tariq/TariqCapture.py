@@ -0,0 +1,195 @@
+"""
+packet capture on an AF_PACKET socket with a TPACKET_V3 ring
+
+the kernel runs the attached BPF filter and fills blocks of the frames
+it lets through in memory shared with us, so a frame costs no system
+call and no copy until its handler decides to keep it.
+"""
+import ctypes, mmap, select, socket, struct
+from subprocess import Popen, PIPE
+
+SOL_PACKET=263
+PACKET_RX_RING=5
+PACKET_STATISTICS=6
+PACKET_VERSION=10
+PACKET_FANOUT=18
+PACKET_FANOUT_DATA=22
+PACKET_FANOUT_CBPF=6
+TPACKET_V3=2
+SO_ATTACH_FILTER=26
+ETH_P_IP=0x0800
+TP_STATUS_KERNEL=0
+TP_STATUS_USER=1
+# BPF loads at this offset are relative to the network header
+SKF_NET_OFF=-0x100000
+
+# struct tpacket_req3
+TPACKET_REQ3=struct.Struct('7I')
+# struct tpacket_block_desc: version, offset_to_priv, then tpacket_hdr_v1's
+# block_status, num_pkts, offset_to_first_pkt
+BLOCK_DESC=struct.Struct('5I')
+BLOCK_STATUS=struct.Struct('I')
+BLOCK_STATUS_OFFSET=8
+# struct tpacket3_hdr up to tp_net
+TPACKET3_HDR=struct.Struct('6IHH')
+# struct tpacket_stats_v3
+TPACKET_STATS_V3=struct.Struct('3I')
+
+class CaptureError(Exception):
+    pass
+
+# length of the TCP payload in a BPF filter expression
+PAYLOAD_LEN="(ip[2:2] - ((ip[0] & 0xf) << 2) - ((tcp[12] & 0xf0) >> 2))"
+
+def knock_filter(ports, min_len=1, max_len=0, reset_range=None):
+    """
+    a filter expression passing only unfragmented knocks, SYNs to one of
+    ports carrying min_len to max_len bytes (0 for no limit), and answers,
+    RSTs with a payload to the last port.  if reset_range is given, the
+    SYNs to any port in it pass too, they reset the sender's sequence.
+    """
+    dst=" or ".join("dst port %d" % p for p in sorted(set(ports)))
+    syn="tcp[tcpflags] == tcp-syn and (%s) and %s >= %d" % (dst, PAYLOAD_LEN, max(1, min_len))
+    if max_len: syn+=" and %s <= %d" % (PAYLOAD_LEN, max_len)
+    clauses=[syn, "tcp[tcpflags] == tcp-rst and dst port %d and %s > 0" % (ports[-1], PAYLOAD_LEN)]
+    if reset_range: clauses.append("tcp[tcpflags] == tcp-syn and dst portrange %s" % reset_range)
+    return "tcp and (ip[6:2] & 0x1fff) == 0 and ((%s))" % ") or (".join(clauses)
+
+def filter_from_conf(c):
+    """
+    the capture filter for the server's config
+    """
+    ports=[int(i.strip()) for i in c['secret_ports'].split(',')]
+    just_check_sequence=c['just_check_sequence'].strip()=='1'
+    sniff_range=c['sniff_range'].strip()
+    if c.get('tight_filter','1').strip()=='1':
+        return knock_filter(ports, int(c.get('knock_min_len','1').strip()),
+          int(c.get('knock_max_len','0').strip()), None if just_check_sequence else sniff_range)
+    if just_check_sequence:
+        return "tcp and ( %s )" % " or ".join("dst port %d" % p for p in ports)
+    return "tcp and dst portrange %s" % sniff_range
+
+def compile_filter(expr, iface=None, tcpdump='tcpdump'):
+    """
+    compiles a tcpdump filter expression with tcpdump -ddd into a list
+    of (code, jt, jf, k) BPF instructions, for the link type of iface or,
+    without one, for Ethernet rather than whatever tcpdump's default
+    device is, as a ring on every interface gets Ethernet frames from
+    all but the odd tunnel
+    """
+    cmd=[tcpdump, '-ddd']
+    if iface: cmd+=['-i', iface]
+    else: cmd+=['-y', 'EN10MB']
+    try:
+        p=Popen(cmd+[expr], stdout=PIPE, stderr=PIPE)
+        out,err=p.communicate()
+    except OSError as e:
+        raise CaptureError("could not run %s: %s" % (tcpdump, e))
+    if p.returncode: raise CaptureError("could not compile filter [%s]: %s" % (expr, err.strip()))
+    lines=out.strip().splitlines()
+    n=int(lines[0])
+    return [tuple(int(i) for i in l.split()) for l in lines[1:n+1]]
+
+def _fprog(prog):
+    """
+    packs BPF instructions as compile_filter() returns them into a
+    struct sock_fprog, returns it and the buffer it points to
+    """
+    # struct sock_filter is u16 code, u8 jt, u8 jf, u32 k
+    buf=ctypes.create_string_buffer(b''.join(struct.pack('HBBI', *i) for i in prog))
+    # struct sock_fprog is an unsigned short and a pointer
+    return struct.pack('HP', len(prog), ctypes.addressof(buf)), buf
+
+def attach_filter(sock, prog):
+    fprog,buf=_fprog(prog)
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+def source_shard_prog(n):
+    """
+    a fanout program sending each frame to socket (source ip % n), so all
+    the packets of a source reach the same one
+    """
+    return [(0x20, 0, 0, (SKF_NET_OFF+12) & 0xffffffff), # ld [net+12]
+      (0x94, 0, 0, n), # mod #n
+      (0x16, 0, 0, 0)] # ret a
+
+def join_fanout(sock, group, n):
+    """
+    joins sock to fanout group group of n sockets sharded by source ip
+    """
+    sock.setsockopt(SOL_PACKET, PACKET_FANOUT, (group & 0xffff) | (PACKET_FANOUT_CBPF << 16))
+    fprog,buf=_fprog(source_shard_prog(n))
+    sock.setsockopt(SOL_PACKET, PACKET_FANOUT_DATA, fprog)
+
+class PacketRing(object):
+    """
+    captures IPv4 frames on iface, or on every interface if it is None,
+    into a ring of block_nr blocks of block_size bytes.  the kernel hands
+    a block over when it is full or timeout_ms after its first frame.
+    with fanout=(group, n) the ring shares the frames with the other
+    rings of fanout group group, n in all, each gets those of its sources.
+    the ring takes block_size*block_nr bytes of unswappable kernel memory.
+    """
+    def __init__(self, iface=None, prog=None, block_size=1<<20, block_nr=8, frame_size=2048, timeout_ms=10, fanout=None):
+        self._block_size=block_size
+        self._block_nr=block_nr
+        self.sock=socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_IP))
+        try:
+            # filter first, so no frame gets in unfiltered
+            if prog: attach_filter(self.sock, prog)
+            self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, TPACKET_REQ3.pack(block_size, block_nr,
+              frame_size, block_size*block_nr//frame_size, timeout_ms, 0, 0))
+            self._ring=mmap.mmap(self.sock.fileno(), block_size*block_nr, mmap.MAP_SHARED, mmap.PROT_READ|mmap.PROT_WRITE)
+            if iface: self.sock.bind((iface, ETH_P_IP))
+            if fanout: join_fanout(self.sock, *fanout)
+        except:
+            self.sock.close()
+            raise
+        self._block=0
+        self.frames=0
+        self.blocks=0
+        self.errors=0
+
+    def next_block(self, handler, timeout_ms=-1):
+        """
+        waits up to timeout_ms for the next block and calls handler(ip)
+        for every frame in it, ip is a read only buffer over the frame in
+        the ring from its IP header on, only valid while handler runs.
+        returns the number of frames handled.
+        """
+        off=self._block*self._block_size
+        if not BLOCK_STATUS.unpack_from(self._ring, off+BLOCK_STATUS_OFFSET)[0] & TP_STATUS_USER:
+            p=select.poll()
+            p.register(self.sock, select.POLLIN|select.POLLERR)
+            p.poll(timeout_ms)
+        version,priv,status,n,first=BLOCK_DESC.unpack_from(self._ring, off)
+        if not status & TP_STATUS_USER: return 0
+        p=off+first
+        for i in range(n):
+            next_offset,sec,nsec,snaplen,length,pkt_status,mac,net=TPACKET3_HDR.unpack_from(self._ring, p)
+            try: handler(buffer(self._ring, p+net, mac+snaplen-net))
+            except Exception as e:
+                self.errors+=1
+                print (" ** Error handling a frame: %s") % e
+            p+=next_offset
+        # give the block back to the kernel
+        BLOCK_STATUS.pack_into(self._ring, off+BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+        self._block=(self._block+1)%self._block_nr
+        self.frames+=n
+        self.blocks+=1
+        return n
+
+    def run(self, handler):
+        while True:
+            self.next_block(handler)
+
+    def stats(self):
+        # reading the kernel counters resets them
+        packets,drops,freezes=TPACKET_STATS_V3.unpack(self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, TPACKET_STATS_V3.size))
+        return {'frames': self.frames, 'blocks': self.blocks, 'errors': self.errors,
+          'kernel_packets': packets, 'kernel_drops': drops}
+
+    def close(self):
+        self._ring.close()
+        self.sock.close()
@@ -1,12 +1,13 @@
 #! /usr/bin/python3
 
-import sys, os, os.path, re, random, glob
+import sys, os, os.path, re, random, glob, socket
 import StringIO
 import Steganography
 
-import gnupg
+from TariqCrypto import make_backend
 from time import time, sleep
 from TariqUtils import readconf, get_fingerprint, dec
+from TariqSocket import RawSocket
 
 
 import sys
@@ -20,16 +21,17 @@ import scapy
 bigS=re.compile(r'^\S+$')
 cmd_re=re.compile(r'^([CEO]) ') # close port, execute command, open port
 
-def gen_payload(img_fn, s):
+def gen_payload(img_fn, s, framed=False):
   """
   put text s into image file img_fn x
-  and return the modified image file content
+  and return the modified image file content,
+  framed selects the length prefixed stego format
   """
   in_file=StringIO.StringIO(s)
   out_file=StringIO.StringIO()
   # for example in 16-bit they use 565 for rgb see http://en.wikipedia.org/wiki/Color_depth
   # because human eye is more sensitive to the color green
-  Steganography.encode(img_fn, in_file, red_bits=1, green_bits=1, blue_bits=1).save(out_file,format='png')
+  Steganography.encode(img_fn, in_file, red_bits=1, green_bits=1, blue_bits=1, framed=framed).save(out_file,format='png')
   return out_file.getvalue()
 
 def split_msg(n, msg):
@@ -41,44 +43,56 @@ def split_msg(n, msg):
   msgs.append(msg[j:])
   return msgs
 
-def knock(gpg, ports, email, img_fn, ip, cmd):
+def knock(gpg, ports, email, img_fn, ip, cmd, framed=False, interval=None):
     """
-    email need not be a real email, it's just a unique id within the system
+    email need not be a real email, it's just a unique id within the system.
+    knocks are interval seconds apart, 1/len(ports) if it is None, and all
+    go in one batch if it is 0
     """
     if not bigS.match(email): raise KeyError
     fingerprint=get_fingerprint(gpg, email=email) # just to make sure it exists
     if not cmd_re.match(cmd): return -1
     s=email+" "+cmd
-    msg=gen_payload(img_fn, s)
+    msg=gen_payload(img_fn, s, framed)
     l=len(msg)
     print (l)
     # open('delme2.png','wb+').write(msg)
     n=len(ports)
     msgs=split_msg(n, msg)
-    t=1.0/n
-    sp=RandShort()
-    # knock all but last ports
-    for i,p in enumerate(ports[:-1]):
-        pk=IP(dst=ip)/TCP(flags='S', sport=sp, dport=p)/msgs[i]
-        send(pk)
-        sleep(t)
-    # knock last port and wait response
-    i,p=-1,ports[-1]
-    pk=IP(dst=ip)/TCP(flags='S', sport=sp, dport=p)/msgs[i]
-    r,u=sr(pk,timeout=0.5)
-    if len(r)==0: print ("** Error: no response")
-    print (r.__repr__())
-    for pk in r[0]:
-        print ("Got answer:",)
-        if pk.payload.flags!=18: print ("skipped"); continue
-        print ("OK")
-        enc_blob=str(pk.payload.payload)
-        # print "payload: [%s]" % enc_blob
-        print ("** SENDING REST:",)
-        dec_blob=dec(gpg, enc_blob)
-        rpk=IP(dst=pk.src,src=pk.dst)/TCP(flags='R',dport=pk.sport, sport=pk.dport, seq=pk.seq+1)/dec_blob
-        send(rpk)
+    if interval is None: interval=1.0/n
+    # ip may be a host name, the answer comes from its address
+    ip=socket.gethostbyname(ip)
+    sp=int(RandShort())
+    # build every knock before sending the first one
+    pks=[str(IP(dst=ip)/TCP(flags='S', sport=sp, dport=p)/msgs[i]) for i,p in enumerate(ports)]
+    sock=RawSocket()
+    try:
+        # knock all but last ports
+        if interval>0:
+            for pk in pks[:-1]:
+                sock.send(pk, ip)
+                sleep(interval)
+        else: sock.send_batch(pks[:-1], ip)
+        # knock last port and wait response
+        sock.send(pks[-1], ip)
+        for raw in sock.recv(0.5):
+            pk=IP(raw)
+            if pk.src!=ip or pk.payload.sport!=ports[-1] or pk.payload.dport!=sp: continue
+            print ("Got answer:",)
+            if pk.payload.flags!=18: print ("skipped"); continue
+            print ("OK")
+            enc_blob=str(pk.payload.payload)
+            # print "payload: [%s]" % enc_blob
+            print ("** SENDING REST:",)
+            dec_blob=dec(gpg, enc_blob)
+            rpk=IP(dst=pk.src,src=pk.dst)/TCP(flags='R',dport=pk.sport, sport=pk.dport, seq=pk.seq+1)/dec_blob
+            sock.send(str(rpk), ip)
+            return 0
+        print ("** Error: no response")
+    finally:
+        sock.close()
     return 0
+
 from getopt import getopt, GetoptError
 
 def usage():
@@ -94,8 +108,8 @@ Usage: {0} [-c CONF] [-p PORTS] [-i IMG_DIR] [-g GPGDIR] [-u USERID] TARGET COMM
 
 
 \tCOMMAD: one of the following
-\t\tO PORT
-\t\t\t* opens specified port for you
+\t\tO PORT [SECONDS]
+\t\t\t* opens specified port for you, for SECONDS if given
 \t\tC PORT
 \t\t\t* closes specified port
 \t\tE CMD
@@ -163,14 +177,17 @@ def main():
         print (" gpg dir not found")
         usage()
         exit(5)
-    gpg = gnupg.GPG(gnupghome=gpg_dir)
+    gpg = make_backend(c.get('crypto_backend','gnupg'), gpg_dir)
     if len(args)<3:
         print (" ** missing TARGET CMD ARGS")
         usage()
         exit(6)
     target=args[0]
     cmd=" ".join(args[1:])
-    knock(gpg, tariqPorts, user, img , target, cmd)
+    framed=c.get('stego_framed','0').strip()=='1'
+    interval=c.get('knock_interval','').strip()
+    interval=float(interval) if interval else None
+    knock(gpg, tariqPorts, user, img , target, cmd, framed, interval)
 
 if __name__=='__main__':
     main()
@@ -0,0 +1,67 @@
+"""
+crypto backends used by TariqUtils.enc and dec
+
+a backend has a gnupghome, list_keys() as gnupg.GPG has it, and
+encrypt(data, fingerprint) and decrypt(data) that return strings.  one
+that caches keys also has keys_changed(), called by TariqUtils.KeyIndex
+when the keyring changed on disk.  make_backend() picks one by the name
+given in the config file.
+"""
+import gnupg
+
+try:
+    import pgpy
+except ImportError:
+    pgpy = None
+
+class GnupgBackend(object):
+    """
+    runs a gpg process for every call through gnupg.GPG
+    """
+    def __init__(self, gnupghome, gpgbinary='gpg'):
+        self.gpg=gnupg.GPG(gpgbinary=gpgbinary, gnupghome=gnupghome)
+        self.gnupghome=self.gpg.gnupghome
+
+    def list_keys(self):
+        return self.gpg.list_keys()
+
+    def encrypt(self, data, fingerprint):
+        return self.gpg.encrypt(data, fingerprint).data
+
+    def decrypt(self, data):
+        return self.gpg.decrypt(data).data
+
+class PGPyBackend(GnupgBackend):
+    """
+    encrypts in process with PGPy, so a challenge costs no process at
+    all.  public keys are exported from the keyring the first time they
+    are used and again after it changes.  decrypting and listing keys
+    still go through gpg, secret keys never leave the keyring.
+    """
+    def __init__(self, gnupghome, gpgbinary='gpg'):
+        if pgpy is None:
+            raise ImportError("the pgpy crypto backend needs PGPy installed")
+        GnupgBackend.__init__(self, gnupghome, gpgbinary)
+        self._keys={}
+
+    def keys_changed(self):
+        self._keys={}
+
+    def _key(self, fingerprint):
+        key=self._keys.get(fingerprint)
+        if key is None:
+            armored=self.gpg.export_keys(fingerprint)
+            if not armored: raise KeyError(fingerprint)
+            key=pgpy.PGPKey.from_blob(armored)[0]
+            self._keys[fingerprint]=key
+        return key
+
+    def encrypt(self, data, fingerprint):
+        return str(self._key(fingerprint).encrypt(pgpy.PGPMessage.new(data)))
+
+BACKENDS={'gnupg': GnupgBackend, 'pgpy': PGPyBackend}
+
+def make_backend(name, gnupghome, gpgbinary='gpg'):
+    name=(name or 'gnupg').strip()
+    if name not in BACKENDS: raise ValueError("unknown crypto backend [%s]" % name)
+    return BACKENDS[name](gnupghome, gpgbinary)
@@ -0,0 +1,146 @@
+"""
+supervisor for the shell commands run by the server
+"""
+import os, signal, select, time, fcntl
+from collections import deque
+from threading import Thread, Lock
+from subprocess import Popen
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+RLIMITS={'cpu': 'RLIMIT_CPU', 'as': 'RLIMIT_AS', 'nofile': 'RLIMIT_NOFILE',
+  'nproc': 'RLIMIT_NPROC', 'fsize': 'RLIMIT_FSIZE', 'core': 'RLIMIT_CORE'}
+
+def parse_rlimits(s):
+    """
+    parses "cpu:60,as:536870912" into [(resource.RLIMIT_CPU, 60), ...]
+    """
+    r=[]
+    for i in s.split(','):
+        i=i.strip()
+        if not i: continue
+        name,v=i.split(':',1)
+        name=name.strip()
+        if name not in RLIMITS: raise ValueError("unknown resource limit [%s]" % name)
+        if resource is None: raise ImportError("resource limits need the resource module")
+        r.append((getattr(resource, RLIMITS[name]), int(v)))
+    return r
+
+class ProcessSupervisor(object):
+    """
+    runs at most max_running commands at a time, up to max_queued more
+    wait their turn and the rest are refused.  each command gets its own
+    session so a timeout kills it with its children, and the rlimits
+    given as (resource, limit) pairs.
+
+    one thread starts and reaps the commands.  it sleeps until a child
+    exits, woken by the child's pidfd where the system has them, or else
+    by SIGCHLD, so nothing is polled while commands run.  without pidfd
+    the supervisor must be made in the main thread to catch SIGCHLD.
+    """
+    def __init__(self, max_running=8, max_queued=256, timeout=0, rlimits=()):
+        self.max_running=max(1, max_running)
+        self.max_queued=max_queued
+        self.timeout=timeout
+        self._rlimits=list(rlimits)
+        self._lock=Lock()
+        self._queue=deque()
+        # Popen -> (cmd, deadline or None, pidfd or None)
+        self._running={}
+        self._r,self._w=os.pipe()
+        for fd in (self._r, self._w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._pidfd=hasattr(os, 'pidfd_open')
+        if not self._pidfd: signal.signal(signal.SIGCHLD, self._sigchld)
+        self.started=0
+        self.finished=0
+        self.failed=0
+        self.killed=0
+        self.rejected=0
+        t=Thread(target=self._loop, name="exec-supervisor")
+        t.setDaemon(True)
+        t.start()
+
+    def run(self, cmd, timeout=None):
+        """
+        queues cmd to be run by /bin/bash, returns False if the queue is
+        full.  timeout overrides the supervisor's, 0 means none.
+        """
+        if timeout is None: timeout=self.timeout
+        with self._lock:
+            if len(self._queue)>=self.max_queued:
+                self.rejected+=1
+                return False
+            self._queue.append((cmd, timeout))
+        self._wake()
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {'running': len(self._running), 'queued': len(self._queue),
+              'started': self.started, 'finished': self.finished, 'failed': self.failed,
+              'killed': self.killed, 'rejected': self.rejected}
+
+    def _wake(self):
+        try: os.write(self._w, b'x')
+        except OSError: pass # the pipe is full, a wake up is pending anyway
+
+    def _sigchld(self, signum, frame):
+        self._wake()
+
+    def _preexec(self):
+        os.setsid()
+        for r,v in self._rlimits:
+            resource.setrlimit(r, (v, v))
+
+    def _start(self, cmd, timeout):
+        try: p=Popen(cmd,0,'/bin/bash',shell=True, preexec_fn=self._preexec)
+        except OSError as e:
+            print (" ** Error: could not run [%s]: %s") % (cmd, e)
+            with self._lock: self.failed+=1
+            return
+        pidfd=os.pidfd_open(p.pid) if self._pidfd else None
+        deadline=time.time()+timeout if timeout>0 else None
+        with self._lock:
+            self._running[p]=(cmd, deadline, pidfd)
+            self.started+=1
+
+    def _reap(self):
+        for p,(cmd,deadline,pidfd) in list(self._running.items()):
+            if p.poll() is None: continue
+            if pidfd is not None: os.close(pidfd)
+            with self._lock:
+                del self._running[p]
+                self.finished+=1
+                if p.returncode: self.failed+=1
+
+    def _kill_late(self, now):
+        for p,(cmd,deadline,pidfd) in list(self._running.items()):
+            if deadline is None or deadline>now: continue
+            print (" ** [%s] took too long, killing it") % cmd
+            try: os.killpg(p.pid, signal.SIGKILL)
+            except OSError: pass
+            with self._lock:
+                self._running[p]=(cmd, None, pidfd)
+                self.killed+=1
+
+    def _loop(self):
+        while True:
+            while True:
+                with self._lock:
+                    if not self._queue or len(self._running)>=self.max_running: break
+                    cmd,timeout=self._queue.popleft()
+                self._start(cmd, timeout)
+            fds=[self._r]+[i[2] for i in self._running.values() if i[2] is not None]
+            deadlines=[i[1] for i in self._running.values() if i[1] is not None]
+            wait=max(0.0, min(deadlines)-time.time()) if deadlines else None
+            try: select.select(fds, [], [], wait)
+            except (select.error, OSError): pass # interrupted by SIGCHLD
+            try:
+                while os.read(self._r, 4096): pass
+            except OSError: pass
+            self._reap()
+            self._kill_late(time.time())
@@ -0,0 +1,119 @@
+"""
+multi-process capture: workers_n TariqServer processes share the
+captured frames through a PACKET_FANOUT group sharded by source ip, so
+all the knocks and the answer of a client reach the same worker, which
+keeps that client's knock and challenge state to itself
+"""
+import os, signal, time, multiprocessing
+from threading import Thread
+from Queue import Empty
+
+# a worker dying sooner than this after starting is failing on start,
+# it is restarted after a wait that doubles each time, up to the longest
+STABLE_TIME=30.0
+MAX_RESTART_DELAY=60.0
+
+def _report(server, index, stats_q, interval):
+    while True:
+        time.sleep(interval)
+        try: stats_q.put((index, server.stats()))
+        except Exception as e: print (" ** Error: worker %d could not report stats: %s") % (index, e)
+
+def _worker(fn, index, group, workers_n, stats_q, interval):
+    # exit cleanly on terminate(), so the worker's decode pool goes with it
+    def stop(signum, frame): raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    from TariqServer import TariqServer
+    server=TariqServer(fn, fanout=(group, workers_n))
+    if interval>0:
+        t=Thread(target=_report, args=(server, index, stats_q, interval))
+        t.setDaemon(True)
+        t.start()
+    server()
+
+def combine_stats(l):
+    """
+    adds up the stats of the workers, keeping the worst of the maxima
+    and averaging the averages
+    """
+    l=[i for i in l if i is not None]
+    if not l: return {}
+    if isinstance(l[0], dict):
+        r={}
+        for k in l[0]:
+            v=[i.get(k) for i in l]
+            if k.endswith('_max'): r[k]=max(v)
+            elif k.endswith('_avg') or k.endswith('_last'): r[k]=sum(v)/float(len(v))
+            else: r[k]=combine_stats(v)
+        return r
+    if isinstance(l[0], list): return [combine_stats(list(i)) for i in zip(*l)]
+    return sum(l)
+
+class FanoutSupervisor(object):
+    """
+    starts workers_n capture workers, restarts any that dies, waiting
+    restart_delay seconds when it died within STABLE_TIME of starting,
+    twice as long each time it does so again, up to MAX_RESTART_DELAY,
+    and prints their combined stats every interval seconds, never if it
+    is 0.  the workers are not daemonic, so they may have a decode pool
+    of their own, run() stops them when it returns.  they always capture
+    through a PacketRing, whatever the capture key says.
+    """
+    def __init__(self, fn, workers_n, interval=60.0, restart_delay=1.0):
+        self._fn=fn
+        self._n=workers_n
+        self._interval=interval
+        self._restart_delay=restart_delay
+        self._group=os.getpid() & 0xffff
+        self._stats_q=multiprocessing.Queue()
+        self._procs=[None]*workers_n
+        self._started=[0.0]*workers_n
+        self._delay=[0.0]*workers_n
+        self._stats=[None]*workers_n
+        self.restarts=0
+
+    def _start(self, index):
+        p=multiprocessing.Process(target=_worker, name="tariq-worker-%d" % index,
+          args=(self._fn, index, self._group, self._n, self._stats_q, self._interval))
+        p.start()
+        self._procs[index]=p
+        self._started[index]=time.time()
+
+    def _check(self):
+        for i,p in enumerate(self._procs):
+            if p.is_alive(): continue
+            print (" ** worker %d exited with %s, restarting it") % (i, p.exitcode)
+            if time.time()-self._started[i]<STABLE_TIME:
+                self._delay[i]=min(max(2*self._delay[i], self._restart_delay), MAX_RESTART_DELAY)
+                time.sleep(self._delay[i])
+            else: self._delay[i]=0.0
+            self._stats[i]=None
+            self.restarts+=1
+            self._start(i)
+
+    def stats(self):
+        r=combine_stats(self._stats)
+        r['workers']=sum(1 for p in self._procs if p and p.is_alive())
+        r['restarts']=self.restarts
+        return r
+
+    def run(self):
+        def stop(signum, frame): raise SystemExit(0)
+        signal.signal(signal.SIGTERM, stop)
+        for i in range(self._n): self._start(i)
+        last=time.time()
+        try:
+            while True:
+                try:
+                    i,s=self._stats_q.get(True, 1.0)
+                    self._stats[i]=s
+                except Empty: pass
+                self._check()
+                if self._interval>0 and time.time()-last>=self._interval:
+                    last=time.time()
+                    print ("** stats=%r") % self.stats()
+        finally:
+            for p in self._procs:
+                if p and p.is_alive(): p.terminate()
+            for p in self._procs:
+                if p: p.join(5)
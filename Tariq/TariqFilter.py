@@ -0,0 +1,32 @@
+#! /usr/bin/python3
+"""
+prints the capture filter the server makes from its config file and
+how many BPF instructions it compiles to
+"""
+import os, sys
+
+from TariqUtils import readconf
+from TariqCapture import filter_from_conf, compile_filter, CaptureError
+
+def main():
+    if len(sys.argv)==2 and os.path.exists(sys.argv[1]): fn=sys.argv[1]
+    else: fn='/etc/tariq/server.conf'
+
+    if not os.path.exists(fn):
+        fn=os.path.join(os.path.dirname(sys.argv[0]),'server.conf')
+    if not os.path.exists(fn):
+        fn=os.path.abspath('server.conf')
+    if not os.path.exists(fn):
+        print (" ** Error: config file not found")
+        exit(1)
+    c=readconf(fn)
+    f=filter_from_conf(c)
+    print (f)
+    try: prog=compile_filter(f, c.get('capture_iface','').strip() or None)
+    except CaptureError as e:
+        print (" ** Error: %s") % e
+        exit(1)
+    print ("%d BPF instructions") % len(prog)
+
+if __name__=='__main__':
+    main()
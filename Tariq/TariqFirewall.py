@@ -0,0 +1,350 @@
+"""
+firewall backends that open and close ports for the server
+
+a backend has grant(ip, dport, lifetime) and revoke(ip, dport), called
+from the server's worker threads, and stats().  a backend whose expires
+is True drops grants after their lifetime on its own, for the others the
+server revokes them.  make_firewall() picks one by the name given in the
+config file.
+"""
+import re, shlex, time
+from threading import Thread, Condition, Lock
+from subprocess import Popen, PIPE
+
+IPTABLES='/sbin/iptables'
+IPTABLES_RESTORE='/sbin/iptables-restore'
+NFT='/usr/sbin/nft'
+
+def rule_re(template):
+    """
+    a regex matching the rules made from template as iptables -S prints them
+    """
+    return re.compile(re.escape(template).replace('\\{','{').replace('\\}','}').format(ip=r'(?P<ip>[\d.]+)(?:/\S*)?', dport=r'(?P<dport>\d+)'))
+
+def run_iptables(rule):
+    """
+    runs iptables on rule, as the templates write it, and waits for it,
+    returns True if it succeeded.  -w waits for the xtables lock rather
+    than failing while another iptables holds it.
+    """
+    try:
+        p=Popen([IPTABLES, '-w']+shlex.split(rule), stderr=PIPE)
+        err=p.communicate()[1]
+    except Exception as e:
+        print (" ** Error: iptables failed: %s") % e
+        return False
+    if p.returncode:
+        print (" ** Error: iptables rejected [%s]: %s") % (rule, err.strip())
+        return False
+    return True
+
+class GrantRegistry(object):
+    """
+    the rules in our chain keyed by (ip, proto, dport), so a grant is
+    looked up in O(1) and a rule is deleted by its spec without listing
+    the chain.  a key may have more than one rule when the chain already
+    had duplicates at startup, a revoke deletes them all.
+    """
+    def __init__(self):
+        self._d={}
+        self._lock=Lock()
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def add(self, key, rule):
+        """
+        returns False if key is granted already
+        """
+        with self._lock:
+            if key in self._d: return False
+            self._d[key]=[rule]
+            return True
+
+    def pop(self, key):
+        """
+        returns the rules of key, an empty list if it was not granted
+        """
+        with self._lock:
+            return self._d.pop(key, [])
+
+    def sync(self, rules, res):
+        """
+        rebuilds the registry from rules as iptables -S prints them,
+        res is a list of (proto, rule_re) telling which rules are ours
+        """
+        d={}
+        for rule in rules:
+            for proto,r in res:
+                m=r.match(rule)
+                if m:
+                    d.setdefault((m.group('ip'), proto, int(m.group('dport'))), []).append(rule)
+                    break
+        with self._lock:
+            self._d=d
+
+class IptablesBackend(object):
+    """
+    runs /sbin/iptables once for every rule added or deleted, in the
+    calling thread and apart from the server's E commands.  the rules
+    are read from the chain once at startup and tracked from then on,
+    opening a port twice adds no rule and closing it lists nothing.  a
+    rule is tracked once iptables took it, after a failure the rules are
+    read from the chain again.
+    """
+    expires=False
+
+    def __init__(self, chain, open_tcp_port, open_udp_port):
+        self._chain=chain
+        self._templates=(('tcp', open_tcp_port), ('udp', open_udp_port))
+        self._res=[(proto, rule_re(t)) for proto,t in self._templates]
+        self._dump_cmd=IPTABLES+' -w -S '+chain
+        self._grants=GrantRegistry()
+        self._lock=Lock()
+        self._sync()
+
+    def _dump(self):
+        p=Popen(self._dump_cmd, 0, '/bin/bash',shell=True, stdout=PIPE)
+        return p.communicate()[0].strip().splitlines()
+
+    def _sync(self):
+        self._grants.sync([j for j in self._dump() if j.startswith('-A ')], self._res)
+
+    def _adds(self, ip, dport):
+        """
+        registers ip and dport and returns the rules to add for them
+        """
+        rules=[]
+        for proto,t in self._templates:
+            rule=t.format(ip=ip, dport=dport)
+            if self._grants.add((ip, proto, dport), rule): rules.append(rule)
+        return rules
+
+    def _deletes(self, ip, dport):
+        """
+        forgets ip and dport and returns the rules to delete for them
+        """
+        rules=[]
+        for proto,t in self._templates:
+            rules.extend('-D'+rule[2:] for rule in self._grants.pop((ip, proto, dport)))
+        return rules
+
+    def grant(self, ip, dport, lifetime=0):
+        ok=True
+        with self._lock:
+            for proto,t in self._templates:
+                key=(ip, proto, dport)
+                if key in self._grants: continue
+                rule=t.format(ip=ip, dport=dport)
+                if run_iptables(rule): self._grants.add(key, rule)
+                else: ok=False
+            if not ok: self._sync()
+
+    def revoke(self, ip, dport):
+        ok=True
+        with self._lock:
+            for rule in self._deletes(ip, dport):
+                if not run_iptables(rule): ok=False
+            # a rule that is still there is tracked again
+            if not ok: self._sync()
+
+    def stats(self):
+        return {'grants': len(self._grants)}
+
+class IptablesRestoreBackend(IptablesBackend):
+    """
+    queues grants and revokes and applies those that came within window
+    seconds of each other as one iptables-restore --noflush transaction,
+    so a batch costs one process and is applied all at once or not at all.
+    a batch that fails is retried op by op.
+    """
+    def __init__(self, chain, open_tcp_port, open_udp_port, window=0.05, table='filter'):
+        IptablesBackend.__init__(self, chain, open_tcp_port, open_udp_port)
+        self._window=window
+        self._table=table
+        self._cond=Condition()
+        self._pending=[]
+        self.batches=0
+        self.ops=0
+        self.failures=0
+        self._latency=[0.0, 0.0, 0.0]
+        t=Thread(target=self._batcher)
+        t.setDaemon(True)
+        t.start()
+
+    def grant(self, ip, dport, lifetime=0):
+        self._queue(('O', ip, dport))
+
+    def revoke(self, ip, dport):
+        self._queue(('C', ip, dport))
+
+    def stats(self):
+        with self._cond:
+            n=max(self.batches, 1)
+            return {'grants': len(self._grants), 'batches': self.batches, 'ops': self.ops, 'failures': self.failures,
+              'pending': len(self._pending), 'latency_last': self._latency[0],
+              'latency_avg': self._latency[1]/n, 'latency_max': self._latency[2]}
+
+    def _queue(self, op):
+        with self._cond:
+            self._pending.append(op)
+            self._cond.notify()
+
+    def _batcher(self):
+        while True:
+            with self._cond:
+                while not self._pending: self._cond.wait()
+            # let the rest of the batch come in
+            time.sleep(self._window)
+            with self._cond:
+                ops,self._pending=self._pending,[]
+            t0=time.time()
+            ok=self._apply(ops)
+            if not ok: self._retry(ops)
+            dt=time.time()-t0
+            with self._cond:
+                self.batches+=1
+                self.ops+=len(ops)
+                if not ok: self.failures+=1
+                self._latency[0]=dt
+                self._latency[1]+=dt
+                self._latency[2]=max(self._latency[2], dt)
+
+    def _retry(self, ops):
+        """
+        the registry ran ahead of a batch that was not applied: reads it
+        back from the chain and applies the ops one at a time, so one bad
+        op, such as deleting a rule that was removed by hand, does not
+        cost the others theirs
+        """
+        self._sync()
+        for op in ops:
+            if not self._apply([op]): self._sync()
+
+    def _lines(self, ops):
+        lines=[]
+        for cmd,ip,dport in ops:
+            if cmd=='O': lines.extend(self._adds(ip, dport))
+            else: lines.extend(self._deletes(ip, dport))
+        return lines
+
+    def _apply(self, ops):
+        try:
+            lines=self._lines(ops)
+            if not lines: return True
+            p=Popen([IPTABLES_RESTORE, '--noflush'], stdin=PIPE, stderr=PIPE)
+            err=p.communicate('\n'.join(['*'+self._table]+lines+['COMMIT', '']))[1]
+        except Exception as e:
+            print (" ** Error: iptables-restore failed: %s") % e
+            return False
+        if p.returncode:
+            print (" ** Error: iptables-restore rejected a batch of %d ops: %s") % (len(ops), err.strip())
+            return False
+        return True
+
+class NftRunner(object):
+    """
+    feeds a script to nft -f, returns True if nft took all of it
+    """
+    def __call__(self, script):
+        try:
+            p=Popen([NFT, '-f', '-'], stdin=PIPE, stderr=PIPE)
+            err=p.communicate(script)[1]
+        except Exception as e:
+            print (" ** Error: nft failed: %s") % e
+            return False
+        if p.returncode:
+            print (" ** Error: nft rejected [%s]: %s") % (script.strip(), err.strip())
+            return False
+        return True
+
+class DryRunRunner(object):
+    """
+    records the nft scripts instead of running them, for testing
+    without root or nft
+    """
+    def __init__(self, verbose=True):
+        self.commands=[]
+        self._verbose=verbose
+
+    def __call__(self, script):
+        self.commands.extend(script.strip().splitlines())
+        if self._verbose: print (" ** nft: %s") % script.strip().replace('\n', '; ')
+        return True
+
+class NftablesBackend(object):
+    """
+    keeps grants as ip . proto . port elements of an nftables set, one
+    rule in our chain accepts whatever is in it.  the kernel looks a new
+    connection up in the set instead of walking a rule per grant, and
+    with a lifetime it drops elements on its own once they time out.
+    the chain is made in table, to be jumped to as the iptables one was.
+    """
+    expires=True
+
+    def __init__(self, chain, table='inet filter', lifetime=0, runner=None):
+        self._table=table
+        self._chain=chain
+        self._set=chain+'_granted'
+        self._lifetime=lifetime
+        self._runner=runner or NftRunner()
+        self.ops=0
+        self.failures=0
+        self._setup()
+
+    def _setup(self):
+        t=self._table
+        self._nft(
+          "add table %s\n" % t+
+          "add chain %s %s\n" % (t, self._chain)+
+          "add set %s %s { type ipv4_addr . inet_proto . inet_service; flags timeout; }\n" % (t, self._set)+
+          "flush chain %s %s\n" % (t, self._chain)+
+          "add rule %s %s ip saddr . meta l4proto . th dport @%s accept\n" % (t, self._chain, self._set))
+
+    def _elements(self, ip, dport, timeout=''):
+        return ', '.join("%s . %s . %d%s" % (ip, proto, dport, timeout) for proto in ('tcp', 'udp'))
+
+    def _nft(self, script):
+        ok=self._runner(script)
+        self.ops+=1
+        if not ok: self.failures+=1
+        return ok
+
+    def _delete(self, ip, dport):
+        """
+        the script deleting ip and dport from the set whether they are in
+        it or not: add does nothing to an element that is there, and lets
+        delete find one that is not
+        """
+        e=self._elements(ip, dport)
+        return ("add element %s %s { %s }\n" % (self._table, self._set, e)+
+          "delete element %s %s { %s }\n" % (self._table, self._set, e))
+
+    def grant(self, ip, dport, lifetime=None):
+        # add leaves an element that is there alone, so a renewal deletes
+        # it first to start its timeout again, in the same transaction
+        if lifetime is None: lifetime=self._lifetime
+        timeout=" timeout %ds" % lifetime if lifetime>0 else ''
+        self._nft(self._delete(ip, dport)+
+          "add element %s %s { %s }\n" % (self._table, self._set, self._elements(ip, dport, timeout)))
+
+    def revoke(self, ip, dport):
+        self._nft(self._delete(ip, dport))
+
+    def stats(self):
+        return {'ops': self.ops, 'failures': self.failures}
+
+def make_firewall(name, chain, open_tcp_port, open_udp_port, window=0.05, lifetime=0, nft_table='inet filter'):
+    name=(name or 'iptables').strip()
+    if name=='iptables':
+        return IptablesBackend(chain, open_tcp_port, open_udp_port)
+    if name=='iptables-restore':
+        return IptablesRestoreBackend(chain, open_tcp_port, open_udp_port, window)
+    if name=='nft':
+        return NftablesBackend(chain, nft_table, lifetime)
+    if name=='nft-dry-run':
+        return NftablesBackend(chain, nft_table, lifetime, DryRunRunner())
+    raise ValueError("unknown firewall backend [%s]" % name)
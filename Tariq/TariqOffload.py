@@ -0,0 +1,164 @@
+"""
+process pool for stego decoding, so that decodes run on every core
+instead of taking turns on the GIL
+"""
+import os, ctypes, select, time, multiprocessing
+from collections import deque
+from multiprocessing.sharedctypes import RawArray
+from threading import Thread, Lock
+
+import Steganography
+
+# the shared slots, as seen by a worker process
+_shared=None
+
+def _decode(offset, length, kw):
+    # never raises, so that the worker always answers and frees its slot
+    # a view, so the payload is not copied out of the slot
+    try: return True, Steganography.decode_png(memoryview(_shared)[offset:offset+length], **kw)
+    except Exception as e: return False, str(e)
+
+def _worker(shared, conn):
+    global _shared
+    _shared=shared
+    while True:
+        try: offset,length,kw=conn.recv()
+        except (EOFError, KeyboardInterrupt): return
+        conn.send(_decode(offset, length, kw))
+
+class DecodePool(object):
+    """
+    decodes knock payloads in processes_n worker processes.  a payload
+    is copied once into one of slots_n shared memory slots of slot_size
+    bytes and the worker reads it from there, only its position goes
+    through the worker's pipe, and the result comes back to a callback so
+    no thread waits for it.  a worker still decoding timeout seconds after
+    it was handed a payload is killed and replaced, so slow payloads can
+    not hold the workers or the slots.
+
+    create it before starting any thread, the workers are forked.  the
+    ones replacing killed workers are forked later, from the pool's thread.
+    """
+    def __init__(self, processes_n, slots_n, slot_size, timeout):
+        self._slot_size=slot_size
+        self._timeout=timeout
+        self._shared=RawArray(ctypes.c_char, slots_n*slot_size)
+        self._lock=Lock()
+        self._free=list(range(slots_n))
+        # (slot, length, kw, callback) waiting for a worker
+        self._pending=deque()
+        # (process, conn) of the workers with nothing to do
+        self._idle=[self._spawn() for i in range(max(1, processes_n))]
+        # conn -> (process, slot, callback, deadline or None)
+        self._busy={}
+        self._r,self._w=os.pipe()
+        self.done=0
+        self.failed=0
+        self.timeouts=0
+        self.busy=0
+        t=Thread(target=self._loop, name="decode-pool")
+        t.setDaemon(True)
+        t.start()
+
+    def decode(self, buf, length, callback, **kw):
+        """
+        has the first length bytes of bytearray buf decoded with
+        Steganography.decode_png(**kw) and returns True, callback(payload)
+        is called from the pool's thread once it is decoded, not at all if
+        it fails.  returns False if every slot is taken so the caller can
+        decode it itself.
+        """
+        if length>self._slot_size:
+            raise Steganography.StegoFormatError("Knock payload of %d bytes is too large" % length)
+        with self._lock:
+            if not self._free:
+                self.busy+=1
+                return False
+            slot=self._free.pop()
+        src=(ctypes.c_char*length).from_buffer(buf)
+        ctypes.memmove(ctypes.addressof(self._shared)+slot*self._slot_size, src, length)
+        with self._lock:
+            self._pending.append((slot, length, kw, callback))
+            self._dispatch()
+        try: os.write(self._w, b'x')
+        except OSError: pass
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {'done': self.done, 'failed': self.failed, 'timeouts': self.timeouts, 'busy': self.busy,
+              'free_slots': len(self._free), 'pending': len(self._pending)}
+
+    def _spawn(self):
+        conn,child=multiprocessing.Pipe()
+        p=multiprocessing.Process(target=_worker, name="tariq-decode", args=(self._shared, child))
+        p.daemon=True
+        p.start()
+        # so that the worker dying shows as EOF on conn
+        child.close()
+        return p, conn
+
+    def _dispatch(self):
+        # with self._lock held
+        while self._pending and self._idle:
+            p,conn=self._idle.pop()
+            slot,length,kw,callback=self._pending.popleft()
+            conn.send((slot*self._slot_size, length, kw))
+            deadline=time.time()+self._timeout if self._timeout>0 else None
+            self._busy[conn]=(p, slot, callback, deadline)
+
+    def _release(self, conn, worker):
+        """
+        frees the slot of the busy conn and puts worker, conn's own or the
+        one replacing it, back to work
+        """
+        with self._lock:
+            p,slot,callback,deadline=self._busy.pop(conn)
+            self._free.append(slot)
+            self._idle.append(worker)
+            self._dispatch()
+        return callback
+
+    def _replace(self, conn):
+        p=self._busy[conn][0]
+        p.terminate()
+        p.join()
+        conn.close()
+        return self._release(conn, self._spawn())
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                conns=list(self._busy)
+                deadlines=[i[3] for i in self._busy.values() if i[3] is not None]
+            wait=max(0.0, min(deadlines)-time.time()) if deadlines else None
+            try: ready=select.select([self._r]+conns, [], [], wait)[0]
+            except (select.error, OSError): continue
+            if self._r in ready: os.read(self._r, 4096)
+            for conn in ready:
+                if conn is self._r: continue
+                try: ok,d=conn.recv()
+                except (EOFError, IOError):
+                    self._replace(conn)
+                    self.failed+=1
+                    print (" ** Error: a decode worker died")
+                    continue
+                callback=self._release(conn, (self._busy[conn][0], conn))
+                self._result(ok, d, callback)
+            now=time.time()
+            for conn in conns:
+                i=self._busy.get(conn)
+                if i is None or i[3] is None or i[3]>now: continue
+                self._replace(conn)
+                self.timeouts+=1
+                print (" ** decode took more than %g seconds, worker killed") % self._timeout
+
+    def _result(self, ok, d, callback):
+        if not ok:
+            self.failed+=1
+            print ("** malformed knock dropped: %s") % d
+            return
+        self.done+=1
+        # an exception would stop the pool's thread
+        try: callback(d)
+        except Exception as e: print (" ** Error handling a decoded knock: %s") % e
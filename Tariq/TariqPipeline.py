@@ -0,0 +1,160 @@
+"""
+worker stages that take slow work off the sniffing thread, and the
+queue of firewall and command jobs
+"""
+import time
+from collections import OrderedDict, deque
+from Queue import Queue, Full
+from threading import Thread, Lock, Condition
+
+class Stage(object):
+    """
+    a bounded queue served by threads_n threads that call handler(item).
+    put() never blocks, items that do not fit are dropped and counted.
+    stats() reports the queue depth and how long items waited in the
+    queue and took to handle, on average and at worst.
+    """
+    def __init__(self, name, handler, threads_n=1, maxsize=1024):
+        self.name=name
+        self._handler=handler
+        self._q=Queue(maxsize)
+        self._lock=Lock()
+        self.done=0
+        self.dropped=0
+        self.errors=0
+        self._wait=[0.0, 0.0]
+        self._run=[0.0, 0.0]
+        for i in range(threads_n):
+            t=Thread(target=self._worker, name="%s-%d" % (name, i))
+            t.setDaemon(True)
+            t.start()
+
+    def put(self, item):
+        try: self._q.put_nowait((time.time(), item))
+        except Full:
+            self.dropped+=1
+            return False
+        return True
+
+    def qsize(self):
+        return self._q.qsize()
+
+    def stats(self):
+        with self._lock:
+            n=max(self.done, 1)
+            return {'queued': self._q.qsize(), 'done': self.done,
+              'dropped': self.dropped, 'errors': self.errors,
+              'wait_avg': self._wait[0]/n, 'wait_max': self._wait[1],
+              'run_avg': self._run[0]/n, 'run_max': self._run[1]}
+
+    def _worker(self):
+        while True:
+            t0,item=self._q.get()
+            t1=time.time()
+            try: self._handler(item)
+            except Exception as e:
+                print (" ** Error in %s stage: %s") % (self.name, e)
+                with self._lock: self.errors+=1
+            t2=time.time()
+            with self._lock:
+                self.done+=1
+                self._wait[0]+=t1-t0
+                self._wait[1]=max(self._wait[1], t1-t0)
+                self._run[0]+=t2-t1
+                self._run[1]=max(self._run[1], t2-t1)
+
+class ShardedStage(object):
+    """
+    threads_n single threaded stages, items put with the same key always
+    go to the same one so they are handled one at a time and in order
+    """
+    def __init__(self, name, handler, threads_n=1, maxsize=1024):
+        self.name=name
+        self._stages=[Stage("%s%d" % (name, i), handler, 1, maxsize) for i in range(max(1, threads_n))]
+
+    def put(self, key, item):
+        return self._stages[hash(key) % len(self._stages)].put(item)
+
+    def qsize(self):
+        return sum(s.qsize() for s in self._stages)
+
+    def stats(self):
+        return [s.stats() for s in self._stages]
+
+class CoalescingQueue(object):
+    """
+    a FIFO of (ip, cmd, args) jobs where a job waits window seconds
+    before it can be taken, so that a later job for the same ip and port
+    can replace it: opening a port twice opens it once and opening then
+    closing it only closes it.  the replacement keeps its place in the
+    queue.  jobs that are not about a port are never coalesced, so they
+    do not wait and are taken before the port jobs.
+    """
+    def __init__(self, window=0.2, clock=time.time):
+        self.window=window
+        self._clock=clock
+        self._cond=Condition()
+        # key -> [time it can be taken, job]
+        self._d=OrderedDict()
+        # the jobs that are not about a port
+        self._now=deque()
+        self._unfinished=0
+        self.coalesced=0
+
+    def _key(self, job):
+        ip,cmd,args=job
+        if cmd in ('O', 'C'):
+            a=args.split()
+            if a and a[0].isdigit(): return (ip, int(a[0]))
+        return None
+
+    def put(self, job):
+        with self._cond:
+            key=self._key(job)
+            if key is None:
+                self._now.append(job)
+                self._unfinished+=1
+                self._cond.notify()
+                return
+            e=self._d.get(key)
+            if e:
+                e[1]=job
+                self.coalesced+=1
+            else:
+                self._d[key]=[self._clock()+self.window, job]
+                self._unfinished+=1
+            self._cond.notify()
+
+    def get(self, block=True):
+        """
+        returns the oldest job that is not about a port, or else the oldest
+        once its window is over, or None if block is False and there is no
+        such job
+        """
+        with self._cond:
+            while True:
+                if self._now: return self._now.popleft()
+                if self._d:
+                    key=next(iter(self._d))
+                    left=self._d[key][0]-self._clock()
+                    if left<=0: return self._d.pop(key)[1]
+                else: left=None
+                if not block: return None
+                self._cond.wait(left)
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished-=1
+
+    def empty(self):
+        with self._cond:
+            return not self._d and not self._now
+
+    def qsize(self):
+        with self._cond:
+            return len(self._d)+len(self._now)
+
+    def stats(self):
+        with self._cond:
+            return {'queued': len(self._d)+len(self._now), 'unfinished': self._unfinished,
+              'coalesced': self.coalesced}
@@ -0,0 +1,85 @@
+"""
+pool of challenges encrypted ahead of time for every key in the keyring
+"""
+import os, random
+from collections import deque
+from Queue import Queue
+from threading import Thread, Lock
+
+from TariqUtils import get_fingerprint, key_index
+
+def randomblob(m,M):
+  return os.urandom(random.randrange(m,M)).encode('base64')
+
+class ChallengePool(object):
+    """
+    keeps up to size ready (plaintext, ciphertext) challenges for every
+    key known to the gpg backend, refilled by threads_n worker threads.
+    take() hands one out and forgets it, so no challenge is used twice,
+    and falls back to encrypting one inline when the pool has run dry.
+    """
+    def __init__(self, gpg, size, blobm, blobM, threads_n=2):
+        self._gpg=gpg
+        self._size=size
+        self._blobm=blobm
+        self._blobM=blobM
+        self._lock=Lock()
+        # fingerprint -> ready challenges, and how many are being made
+        self._ready={}
+        self._pending={}
+        self._wanted=Queue(0)
+        self.hits=0
+        self.misses=0
+        self.failures=0
+        for i in range(threads_n):
+            t=Thread(target=self._worker)
+            t.setDaemon(True)
+            t.start()
+        for fingerprint in key_index(gpg).fingerprints():
+            self._refill(fingerprint)
+
+    def take(self, **kw):
+        """
+        returns (plaintext, ciphertext) for the key given by email, keyid
+        or fingerprint, raises KeyError if there is no such key
+        """
+        fingerprint=get_fingerprint(self._gpg, **kw)
+        with self._lock:
+            ready=self._ready.get(fingerprint)
+            c=ready.popleft() if ready else None
+        self._refill(fingerprint)
+        if c:
+            self.hits+=1
+            return c
+        self.misses+=1
+        return self._make(fingerprint)
+
+    def stats(self):
+        with self._lock:
+            ready=sum(len(i) for i in self._ready.values())
+        return {'ready': ready, 'queued': self._wanted.qsize(), 'hits': self.hits,
+          'misses': self.misses, 'failures': self.failures}
+
+    def _make(self, fingerprint):
+        dec_blob=randomblob(self._blobm,self._blobM)
+        return dec_blob, self._gpg.encrypt(dec_blob, fingerprint)
+
+    def _refill(self, fingerprint):
+        with self._lock:
+            ready=self._ready.setdefault(fingerprint, deque())
+            n=self._size-len(ready)-self._pending.get(fingerprint, 0)
+            if n>0: self._pending[fingerprint]=self._pending.get(fingerprint, 0)+n
+        for i in range(n):
+            self._wanted.put(fingerprint)
+
+    def _worker(self):
+        while True:
+            fingerprint=self._wanted.get()
+            try: c=self._make(fingerprint)
+            except Exception as e:
+                print (" ** Error: could not make a challenge for [%s]: %s") % (fingerprint, e)
+                c=None
+            with self._lock:
+                self._pending[fingerprint]-=1
+                if c and c[1]: self._ready[fingerprint].append(c)
+                else: self.failures+=1
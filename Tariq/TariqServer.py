@@ -1,16 +1,22 @@
 #! /usr/bin/python3
-import sys, time, hashlib, random
+import sys, time, hashlib, random, socket, struct
 
-import StringIO
 import Steganography
+import PngStream
 
-import gnupg
+from TariqCrypto import make_backend
 
-from Queue import Queue
-from threading import Thread
-from subprocess import Popen, PIPE
+from threading import Thread, Lock
 
 from TariqUtils import readconf, get_fingerprint, enc
+from TariqState import KnockTable, ChallengeTable, TimerWheel
+from TariqPool import ChallengePool, randomblob
+from TariqPipeline import Stage, ShardedStage, CoalescingQueue
+from TariqOffload import DecodePool
+from TariqFirewall import make_firewall
+from TariqExec import ProcessSupervisor, parse_rlimits
+from TariqCapture import PacketRing, compile_filter, filter_from_conf
+from TariqFanout import FanoutSupervisor
 
 
 import sys
@@ -24,8 +30,69 @@ import scapy
 
 cmd_re=re.compile(r'^([CEO]) ') # close port, execute command, open port
 
-def randomblob(m,M):
-  return (''.join(map(lambda i: chr(random.randrange(0,255)), range(random.randrange(m,M))))).encode('base64')
+# the fields of the raw IP and TCP headers looked at before dissecting:
+# version and header length, total length, fragment offset, protocol, source
+IP_HDR=struct.Struct('!BxH2xH1xB2x4s')
+# source port, destination port, sequence number, data offset, flags
+TCP_HDR=struct.Struct('!HHI4xBB')
+TCP_SYN=2
+TCP_RST=4
+
+class KnockSequence(object):
+    """
+    the knocks received so far from one source, each fragment is
+    decoded as it arrives so little is left to do after the last one.
+    with a DecodePool the fragments are only gathered, to be decoded
+    by a worker process after the last one.
+    """
+    def __init__(self, portsN, offload=None, **kw):
+        self.n=0
+        self._portsN=portsN
+        self._offload=offload
+        self._kw=kw
+        self.decoder=None
+        self._raw=None
+        self._rawlen=0
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def nbytes(self):
+        """
+        bytes held for the sequence, the buffers allocated in full
+        """
+        if self._raw is not None: return len(self._raw)
+        return self.decoder.nbytes if self.decoder else 0
+
+    def feed(self, d):
+        """
+        raises Steganography.StegoFormatError if the payload is malformed
+        """
+        # the client splits the image in equal parts, the last one may be a bit longer
+        size_hint=len(d)*self._portsN+self._portsN
+        if self._offload:
+            if self._raw is None:
+                if not d.startswith(PngStream.PNG_SIGNATURE):
+                    raise Steganography.StegoFormatError("Not a PNG file")
+                self._raw=bytearray(size_hint)
+            self._raw[self._rawlen:self._rawlen+len(d)]=d
+            self._rawlen+=len(d)
+        else:
+            if not self.decoder:
+                self.decoder=Steganography.PngPayloadDecoder(size_hint=size_hint, **self._kw)
+            self.decoder.feed(d)
+        self.n+=1
+
+    def finish(self, done):
+        """
+        calls done(payload), from the DecodePool's result thread when a
+        worker process decodes it
+        """
+        if self._raw is None: return done(self.decoder.finish())
+        if self._offload.decode(self._raw, self._rawlen, done, **self._kw): return
+        # no worker free, decode it here
+        done(Steganography.decode_png(bytes(self._raw[:self._rawlen]), **self._kw))
 
 class TariqServer(AnsweringMachine):
     function_name = "TariqServer"
@@ -33,38 +100,49 @@ class TariqServer(AnsweringMachine):
     send_function = staticmethod(send)
     def __init__(self, fn, *args, **kw):
         random.seed(time.time())
-        self._ps=[]
-        self._setsid = getattr(os, 'setsid', None)
-        if not self._setsid: self._setsid = getattr(os, 'setpgrp', None)
-        self._q = Queue(0)
+        # (group, workers_n) when run as a worker of TariqFanout
+        self._fanout = kw.pop('fanout', None)
+        self._ring = None
         self._process_conf(fn)
+        self._q = CoalescingQueue(self._job_coalesce_window)
+        # worker processes are forked before any thread is started
+        self._offload = None
+        if self._decode_processes>0:
+            self._offload = DecodePool(self._decode_processes, self._decode_slots, self._decode_slot_size, self._decode_timeout)
+        self._exec = ProcessSupervisor(self._exec_max_running, self._exec_max_queued,
+          self._exec_timeout, parse_rlimits(self._exec_rlimits))
+        self._firewall = make_firewall(self._firewall_backend, self._iptables_chain,
+          self._open_tcp_port, self._open_udp_port, self._firewall_batch_window,
+          self._grant_lifetime, self._nft_table)
+        self._expiry = TimerWheel(self._expire_grant, self._grant_timer_tick, max_entries=self._grant_max)
         self._start_threads()
         self._portsN=len(self._ports)
-        self._hist={}
-        self._challenge={}
-        self._gpg = gnupg.GPG(gnupghome=self._server_gpg_dir)
+        self._hist=KnockTable(self._knock_ttl, self._knock_max_sources, self._knock_max_bytes)
+        self._challenge=ChallengeTable(self._challenge_ttl, self._challenge_max, self._challenge_max_per_source)
+        self._gpg = make_backend(self._crypto_backend, self._server_gpg_dir)
+        self._pool = None
+        if self._pool_size>0:
+            self._pool = ChallengePool(self._gpg, self._pool_size, self._blobm, self._blobM, self._pool_threads)
+        self._hist_lock = Lock()
+        self._challenge_lock = Lock()
+        self._decode_stage = ShardedStage('decode', self._knock, self._decode_threads, self._stage_queue_max)
+        self._crypto_stage = Stage('crypto', self._send_challenge, self._crypto_threads, self._stage_queue_max)
+        # TariqFanout logs the stats of its workers itself
+        if self._stats_interval>0 and not self._fanout:
+            t = Thread(target=self._log_stats)
+            t.setDaemon(True)
+            t.start()
         AnsweringMachine.__init__(self, *args, **kw)
 
-    def _get_iptables_rule_n(self, ip, dport):
-        """
-        returns rule number or 0 if not found
-        """
-        p=Popen(self._iptables_dump_cmd, 0, '/bin/bash',shell=True, stdout=PIPE)
-        l=p.communicate()[0].strip().splitlines()
-        if not l or not l[0].startswith('-N'): return 0
-        for i,j in enumerate(l):
-            #print "matching with rule %d which is [%s]" % (i,j)
-            m=self._open_tcp_port_re.match(j)
-            if m and m.group('ip')==ip and int(m.group('dport'))==dport:
-                return i
-            m=self._open_udp_port_re.match(j)
-            if m and m.group('ip')==ip and int(m.group('dport'))==dport:
-                return i
-        return 0
+    def _log_stats(self):
+        while True:
+            time.sleep(self._stats_interval)
+            try: print ("** stats=%r") % self.stats()
+            except Exception as e: print (" ** Error: could not get stats: %s") % e
 
     def _run_shell_cmd(self, cmd):
-        self._ps=filter(lambda x: x.poll()!=None,self._ps) # remove terminated processes from _ps list
-        self._ps.append(Popen(cmd,0,'/bin/bash',shell=True, preexec_fn=self._setsid))
+        if not self._exec.run(cmd):
+            print (" ** Error: too many commands waiting, [%s] dropped") % cmd
 
     def _run_cmd(self, ip, cmd, args):
       if cmd=="E":
@@ -74,19 +152,31 @@ class TariqServer(AnsweringMachine):
           if not args.isdigit():
               print (" ** Error: dport should be an integer")
               return
-          k=1
-          while(k):
-              k=self._get_iptables_rule_n(ip, int(args))
-              if k: self._run_shell_cmd('/sbin/iptables -D %s %d' % (self._iptables_chain, k))
+          dport=int(args)
+          self._expiry.cancel((ip, dport))
+          self._firewall.revoke(ip, dport)
       elif cmd=='O':
-          if not args.isdigit():
-              print (" ** Error: dport should be an integer")
+          # O dport [lifetime in seconds]
+          a=args.split()
+          if not a or len(a)>2 or not all(i.isdigit() for i in a):
+              print (" ** Error: dport and lifetime should be integers")
               return
-          self._run_shell_cmd('/sbin/iptables '+self._open_tcp_port.format(ip=ip, dport=args))
-          self._run_shell_cmd('/sbin/iptables '+self._open_udp_port.format(ip=ip, dport=args))
+          dport=int(a[0])
+          lifetime=int(a[1]) if len(a)>1 else self._grant_lifetime
+          # grant_lifetime, when set, caps what a command may ask for
+          if self._grant_lifetime>0 and not 0<lifetime<=self._grant_lifetime:
+              lifetime=self._grant_lifetime
+          self._firewall.grant(ip, dport, lifetime)
+          if lifetime>0 and not self._firewall.expires:
+              self._expiry.schedule((ip, dport), lifetime)
       else:
           print (" ** Error: cmd=[%s] not supported") % cmd
 
+    def _expire_grant(self, key):
+        ip,dport=key
+        print (" ** grant of port %d to [%s] expired") % (dport, ip)
+        self._q.put((ip, 'C', str(dport)))
+
     def _worker(self):
         while self._keepworking:
             self._started=True
@@ -118,27 +208,58 @@ class TariqServer(AnsweringMachine):
         if not os.path.isabs(self._server_gpg_dir):
             self._server_gpg_dir=os.path.join(os.path.dirname(sys.argv[0]),self._server_gpg_dir)
         self._server_gpg_dir=os.path.expanduser(self._server_gpg_dir)
+        self._crypto_backend=c.get('crypto_backend','gnupg')
         self._ports=[int(i.strip()) for i in c['secret_ports'].split(',')]
-        self.filter="tcp and dst portrange %s" % c['sniff_range'].strip()
+        self._port_set=frozenset(self._ports)
+        self.filter=filter_from_conf(c)
         self._threads_n=int(c['threads_n'].strip())
         self._open_tcp_port=c['open_tcp_port'].strip()
         self._open_udp_port=c['open_udp_port'].strip()
-        self._open_tcp_port_re=re.compile(re.escape(self._open_tcp_port).replace('\\{','{').replace('\\}','}').format(ip=r'(?P<ip>[\d.]+)(?:/\S*)?', dport=r'(?P<dport>\d+)'))
-        self._open_udp_port_re=re.compile(re.escape(self._open_udp_port).replace('\\{','{').replace('\\}','}').format(ip=r'(?P<ip>[\d.]+)(?:/\S*)?', dport=r'(?P<dport>\d+)'))
-        self._iptables_chain=c['iptables_chain']
-        self._iptables_dump_cmd='/sbin/iptables -S '+self._iptables_chain
-        if c['just_check_sequence'].strip()=='1':
-            self._filter_more()
+        self._iptables_chain=c['iptables_chain'].strip()
+        self._firewall_backend=c.get('firewall_backend','iptables').strip()
+        self._firewall_batch_window=float(c.get('firewall_batch_window','0.05').strip())
+        self._grant_lifetime=int(c.get('grant_lifetime','0').strip())
+        self._nft_table=c.get('nft_table','inet filter').strip()
+        self._grant_timer_tick=float(c.get('grant_timer_tick','1').strip())
+        self._grant_max=int(c.get('grant_max','65536').strip())
+        self._job_coalesce_window=float(c.get('job_coalesce_window','0.2').strip())
+        self._exec_max_running=int(c.get('exec_max_running','8').strip())
+        self._exec_max_queued=int(c.get('exec_max_queued','256').strip())
+        self._exec_timeout=float(c.get('exec_timeout','0').strip())
+        self._exec_rlimits=c.get('exec_rlimits','').strip()
+        self._capture=c.get('capture','scapy').strip()
+        self._capture_iface=c.get('capture_iface','').strip() or None
+        self._capture_blocks=int(c.get('capture_blocks','8').strip())
+        self._capture_block_size=int(c.get('capture_block_size','1048576').strip())
+        self._stats_interval=float(c.get('stats_interval','60').strip())
+        self._just_check_sequence=c['just_check_sequence'].strip()=='1'
         self._blobm=int(c['min_random_blob_size'].strip())
         self._blobM=int(c['max_random_blob_size'].strip())
+        self._stego_legacy=c.get('stego_legacy','1').strip()=='1'
+        self._stego_max_bytes=int(c.get('stego_max_bytes','4096').strip())
+        self._knock_ttl=float(c.get('knock_timeout','30').strip())
+        self._knock_max_sources=int(c.get('knock_max_sources','4096').strip())
+        self._knock_max_bytes=int(c.get('knock_max_bytes','67108864').strip())
+        self._challenge_ttl=float(c.get('challenge_timeout','60').strip())
+        self._challenge_max=int(c.get('challenge_max','4096').strip())
+        self._challenge_max_per_source=int(c.get('challenge_max_per_source','4').strip())
+        self._pool_size=int(c.get('challenge_pool_size','4').strip())
+        self._pool_threads=int(c.get('challenge_pool_threads','2').strip())
+        self._decode_threads=int(c.get('decode_threads','2').strip())
+        self._crypto_threads=int(c.get('crypto_threads','2').strip())
+        self._stage_queue_max=int(c.get('stage_queue_max','1024').strip())
+        self._decode_processes=int(c.get('decode_processes','0').strip())
+        self._decode_slots=int(c.get('decode_slots',str(2*self._decode_processes)).strip())
+        self._decode_slot_size=int(c.get('decode_slot_size','8388608').strip())
+        self._decode_timeout=float(c.get('decode_timeout','5').strip())
+
+    def __call__(self, *args, **kw):
+        if self._capture!='ring' and not self._fanout: return AnsweringMachine.__call__(self, *args, **kw)
+        prog=compile_filter(self.filter, self._capture_iface)
+        self._ring=PacketRing(self._capture_iface, prog, self._capture_block_size, self._capture_blocks, fanout=self._fanout)
+        print ("** capturing on a %d x %d bytes ring, filter=[%s]") % (self._capture_blocks, self._capture_block_size, self.filter)
+        self._ring.run(self._handle_frame)
 
-    def _filter_more(self):
-        """
-        filter only needed ports to sniff
-        """
-        c=" or ".join("dst port %d" % p for p in self._ports)
-        self.filter = "tcp and ( %s )" % c
-    
     def send_reply(self, reply):
         if reply!=None: self.send_function(reply, **self.optsend)
 
@@ -158,57 +279,158 @@ class TariqServer(AnsweringMachine):
             # make sure it's in right sequence
             if n<self._portsN and self._ports[n]==dp: return True
             elif self._ports[0]==dp:
-                self._hist[s]=[]
+                self._hist[s]=self._new_sequence()
                 return True
             del self._hist[s]
         elif dp==self._ports[0]:
-            self._hist[s]=[]
+            self._hist[s]=self._new_sequence()
             return True
         return False
 
+    def _new_sequence(self):
+        return KnockSequence(self._portsN, self._offload, red_bits=1, green_bits=1, blue_bits=1,
+          legacy=self._stego_legacy, max_bytes=self._stego_max_bytes)
+
+    def stats(self):
+        with self._hist_lock: r={'knocks': self._hist.stats()}
+        with self._challenge_lock: r['challenges']=self._challenge.stats()
+        if self._pool: r['pool']=self._pool.stats()
+        if self._offload: r['offload']=self._offload.stats()
+        r['firewall']=self._firewall.stats()
+        r['expiry']=self._expiry.stats()
+        r['jobs']=self._q.stats()
+        r['exec']=self._exec.stats()
+        if self._ring: r['capture']=self._ring.stats()
+        r['decode']=self._decode_stage.stats()
+        r['crypto']=self._crypto_stage.stats()
+        return r
+
+    def _new_challenge(self, email):
+        """
+        returns (plaintext, ciphertext) of a challenge for email
+        """
+        if self._pool: return self._pool.take(email=email)
+        dec_blob=randomblob(self._blobm,self._blobM)
+        return dec_blob, enc(self._gpg, dec_blob, email=email)
+
     def make_reply(self, req):
-        pk=IP(str(req.payload))
+        # scapy has dissected req already, the fast path only spares the
+        # second parse of what is not a knock or an answer
+        raw=str(req.payload)
+        if self._fast_path(raw): self._classify(IP(raw))
+        return None
+
+    def _handle_frame(self, ip):
+        """
+        ring capture: ip is a buffer over a frame from its IP header on
+        """
+        if self._fast_path(ip): self._classify(IP(str(ip)))
+
+    def _fast_path(self, ip):
+        """
+        reads the raw IP packet and returns True only for a SYN or RST to
+        a secret port, with ring capture anything else is dropped before
+        scapy sees it
+        """
+        if len(ip)<40: return False
+        vhl,total,frag,proto,src=IP_HDR.unpack_from(ip)
+        # tight_filter=0 lets IPv6 through
+        if vhl>>4!=4 or proto!=6 or frag&0x1fff: return False
+        sport,dport,seq,offset,flags=TCP_HDR.unpack_from(ip, (vhl&15)<<2)
+        if flags!=TCP_SYN and flags!=TCP_RST: return False
+        if dport in self._port_set: return True
+        if flags==TCP_SYN and not self._just_check_sequence:
+            # a SYN to any other port resets the sequence of its source,
+            # it goes through the decode stage to keep its order.  only a
+            # source with a sequence in progress has something to reset, so
+            # a scan of the sniffed range queues nothing.  unlocked, a
+            # sequence whose first knock is still queued misses the reset.
+            s=socket.inet_ntoa(src)
+            if self._hist.tracking(s): self._decode_stage.put(s, (s, None, sport, dport, seq, ''))
+        return False
+
+    def _classify(self, pk):
+        """
+        runs on the sniffing thread, it only sorts packets out: knocks go
+        to the decode stage and replies are sent from the crypto stage
+        """
         tcp=pk.payload
         if tcp.flags!=4 and tcp.flags!=2: return None
         d=str(tcp.payload)
         dp=int(tcp.dport)
         s=str(pk.src)
         if tcp.flags==4:
-            if dp!=self._ports[-1] or not self._challenge.has_key(s): return None
-            if d.replace('\0',' ').strip()=='': return None
-            print ("** Got challenge answer=[%s]") % d.__repr__()
-            c,cmd,arg=self._challenge[s]
-            if c==d:
-                print ("** accepted, executing cmd=[%s] arg=[%s]") % (cmd,arg)
-                self._q.put((s, cmd, arg))
-            else: print ("rejected")
-            del self._challenge[s]
+            self._check_answer(s, dp, d)
             return None
-        print ("dp=",dp,)
-        #print "pk=", pk.__repr__()
-        r=self._is_right_knock(s, dp)
-        print ("** right order=", r)
-        if not r: return None
-        self._hist[s].append(d)
-        if len(self._hist[s])==self._portsN:
-            # send challenge
-            img="".join(self._hist[s])
-            del self._hist[s];
-            in_file=StringIO.StringIO(img)
-            try: d=Steganography.decode(in_file, red_bits=1, green_bits=1, blue_bits=1)
-            except: return None
-            try: email,cmd,arg=d.split(' ',2)
-            except ValueError: return None
-            print ("** last valid knock received, cmd=[%s] arg=[%s]") % (cmd, arg)
-            print ("** sending challenge ...")
-            dec_blob=randomblob(self._blobm,self._blobM)
-            enc_blob=enc(self._gpg, dec_blob, email=email)
-            print ("** expecting answer=[%s]") % dec_blob.__repr__()
-            try: self._challenge[s]=(dec_blob, cmd, arg)
-            except KeyError: return None
-            return IP(dst=pk.src,src=pk.dst)/TCP(flags='SA',dport=tcp.sport, sport=tcp.dport, seq=tcp.seq)/enc_blob
+        # all knocks from a source go to the same decode thread, in order
+        if not self._decode_stage.put(s, (s, str(pk.dst), tcp.sport, dp, tcp.seq, d)):
+            print ("** decode queue full, knock dropped")
         return None
 
+    def _check_answer(self, s, dp, d):
+        if dp!=self._ports[-1]: return
+        with self._challenge_lock:
+            if s not in self._challenge: return
+        if d.replace('\0',' ').strip()=='': return
+        print ("** Got challenge answer=[%s]") % d.__repr__()
+        with self._challenge_lock:
+            c=self._challenge.answer(s, d)
+        if c:
+            c,cmd,arg=c
+            print ("** accepted, executing cmd=[%s] arg=[%s]") % (cmd,arg)
+            self._q.put((s, cmd, arg))
+        else: print ("rejected")
+
+    def _forget(self, s, k):
+        with self._hist_lock:
+            if s in self._hist and self._hist[s] is k: del self._hist[s]
+
+    def _knock(self, item):
+        """
+        decode stage: follows the knock sequence of a source and decodes
+        its payload as the fragments come
+        """
+        s,dst,sport,dp,seq,d=item
+        print ("dp=",dp,)
+        with self._hist_lock:
+            r=self._is_right_knock(s, dp)
+            print ("** right order=", r)
+            if not r: return
+            k=self._hist[s]
+            if not self._hist.charge(s, len(d)): return
+        try: k.feed(d)
+        except Steganography.StegoFormatError as e:
+            print ("** malformed knock dropped: %s") % e
+            self._forget(s, k)
+            return
+        # charge what the sequence holds now, not just what came in
+        with self._hist_lock:
+            if self._hist.tracking(s) and self._hist[s] is k and not self._hist.resize(s, k.nbytes): return
+        if len(k)==self._portsN:
+            self._forget(s, k)
+            try: k.finish(lambda d: self._knock_decoded((s, dst, sport, dp, seq), d))
+            except: return
+
+    def _knock_decoded(self, item, d):
+        try: email,cmd,arg=d.split(' ',2)
+        except ValueError: return
+        print ("** last valid knock received, cmd=[%s] arg=[%s]") % (cmd, arg)
+        if not self._crypto_stage.put(item+(email, cmd, arg)):
+            print ("** crypto queue full, challenge dropped")
+
+    def _send_challenge(self, item):
+        """
+        crypto stage: makes the challenge and sends it in a SYN-ACK
+        """
+        s,dst,sport,dp,seq,email,cmd,arg=item
+        print ("** sending challenge ...")
+        try: dec_blob,enc_blob=self._new_challenge(email)
+        except KeyError: return
+        print ("** expecting answer=[%s]") % dec_blob.__repr__()
+        with self._challenge_lock:
+            self._challenge.add(s, (dec_blob, cmd, arg))
+        self.send_reply(IP(dst=s,src=dst)/TCP(flags='SA',dport=sport, sport=dp, seq=seq)/enc_blob)
+
 def main():
     if len(sys.argv)==2 and os.path.exists(sys.argv[1]): fn=sys.argv[1]
     else: fn='/etc/tariq/server.conf'
@@ -220,6 +442,11 @@ def main():
     if not os.path.exists(fn):
         print (" ** Error: config file not found")
         exit(1)
+    c=readconf(fn)
+    workers_n=int(c.get('capture_workers','1').strip())
+    if workers_n>1:
+        FanoutSupervisor(fn, workers_n, float(c.get('stats_interval','60').strip())).run()
+        return
     server=TariqServer(fn)
     server()
 
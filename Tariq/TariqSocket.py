@@ -0,0 +1,77 @@
+"""
+the client's raw socket, one for a whole knock session
+"""
+import ctypes, ctypes.util, os, select, socket, struct, time
+
+class _iovec(ctypes.Structure):
+    _fields_=[('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_=[('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+      ('msg_iov', ctypes.POINTER(_iovec)), ('msg_iovlen', ctypes.c_size_t),
+      ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+      ('msg_flags', ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_=[('msg_hdr', _msghdr), ('msg_len', ctypes.c_uint)]
+
+try:
+    _libc=ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _sendmmsg=_libc.sendmmsg
+except (OSError, AttributeError, TypeError):
+    _sendmmsg=None
+
+class RawSocket(object):
+    """
+    a raw TCP socket that sends whole IP packets and receives every
+    incoming TCP segment, so one socket knocks and gets the challenge
+    """
+    def __init__(self):
+        self.sock=socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_TCP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
+
+    def send(self, pk, dst):
+        self.sock.sendto(pk, (dst, 0))
+
+    def send_batch(self, pks, dst):
+        """
+        sends all of pks in as few system calls as sendmmsg allows, or
+        one by one where there is no sendmmsg
+        """
+        if _sendmmsg is None:
+            for pk in pks: self.send(pk, dst)
+            return
+        n=len(pks)
+        addr=ctypes.create_string_buffer(struct.pack('=H2s4s8x', socket.AF_INET, b'\0\0', socket.inet_aton(dst)))
+        bufs=[ctypes.create_string_buffer(pk, len(pk)) for pk in pks]
+        iov=(_iovec*n)()
+        msgs=(_mmsghdr*n)()
+        for i,b in enumerate(bufs):
+            iov[i].iov_base=ctypes.addressof(b)
+            iov[i].iov_len=len(pks[i])
+            h=msgs[i].msg_hdr
+            h.msg_name=ctypes.addressof(addr)
+            h.msg_namelen=16 # sizeof(struct sockaddr_in)
+            h.msg_iov=ctypes.pointer(iov[i])
+            h.msg_iovlen=1
+        sent=0
+        while sent<n:
+            r=_sendmmsg(self.sock.fileno(), ctypes.byref(msgs, sent*ctypes.sizeof(_mmsghdr)), n-sent, 0)
+            if r<0:
+                e=ctypes.get_errno()
+                raise socket.error(e, os.strerror(e))
+            sent+=r
+
+    def recv(self, timeout):
+        """
+        yields the IP packets received within timeout seconds
+        """
+        deadline=time.time()+timeout
+        while True:
+            left=deadline-time.time()
+            if left<=0: return
+            if not select.select([self.sock], [], [], left)[0]: return
+            yield self.sock.recv(65535)
+
+    def close(self):
+        self.sock.close()
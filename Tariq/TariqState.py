@@ -0,0 +1,291 @@
+"""
+bounded tables for the per source state kept by the server, and the
+timers that expire it
+"""
+import math, time
+from collections import OrderedDict
+from threading import Thread, Lock
+
+class KnockTable(object):
+    """
+    knock sequences in progress keyed by source ip
+
+    entries expire ttl seconds after their last knock and the table never
+    holds more than max_entries sources or max_bytes of payload, the
+    least recently knocked sources are evicted first.  entries are kept
+    in an OrderedDict in the order they were last touched, which is also
+    the order they expire in, so expiring and evicting are O(1) each.
+    """
+    def __init__(self, ttl=30.0, max_entries=4096, max_bytes=64<<20, clock=time.time):
+        self.ttl=ttl
+        self.max_entries=max_entries
+        self.max_bytes=max_bytes
+        self._clock=clock
+        # ip -> [entry, deadline, bytes]
+        self._d=OrderedDict()
+        self.bytes=0
+        self.expired=0
+        self.evicted=0
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, ip):
+        self.expire()
+        return ip in self._d
+
+    def tracking(self, ip):
+        """
+        whether ip has an entry, expired or not.  nothing is expired, so
+        it may be asked without the lock the table is used under
+        """
+        return ip in self._d
+
+    def __getitem__(self, ip):
+        return self._d[ip][0]
+
+    def __setitem__(self, ip, entry):
+        if ip in self._d: self._drop(ip)
+        self._d[ip]=[entry, self._clock()+self.ttl, 0]
+        while len(self._d)>self.max_entries:
+            self._evict()
+
+    def __delitem__(self, ip):
+        self._drop(ip)
+
+    def charge(self, ip, n):
+        """
+        account n more bytes of payload to ip and push its deadline back,
+        returns False if ip was evicted to stay within max_bytes
+        """
+        e=self._d.pop(ip)
+        e[1]=self._clock()+self.ttl
+        e[2]+=n
+        self._d[ip]=e
+        self.bytes+=n
+        while self.bytes>self.max_bytes:
+            self._evict()
+        return ip in self._d
+
+    def resize(self, ip, n):
+        """
+        account n bytes to ip in place of what it had, what its entry
+        really holds once fed, returns False if ip was evicted to stay
+        within max_bytes
+        """
+        e=self._d.get(ip)
+        if e is None: return False
+        self.bytes+=n-e[2]
+        e[2]=n
+        while self.bytes>self.max_bytes:
+            self._evict()
+        return ip in self._d
+
+    def expire(self, now=None):
+        """
+        drop every entry whose deadline has passed
+        """
+        if now is None: now=self._clock()
+        while self._d:
+            ip=next(iter(self._d))
+            if self._d[ip][1]>now: break
+            self._drop(ip)
+            self.expired+=1
+
+    def stats(self):
+        return {'entries': len(self._d), 'bytes': self.bytes,
+          'expired': self.expired, 'evicted': self.evicted}
+
+    def _evict(self):
+        self._drop(next(iter(self._d)))
+        self.evicted+=1
+
+    def _drop(self, ip):
+        self.bytes-=self._d.pop(ip)[2]
+
+class ChallengeTable(object):
+    """
+    outstanding challenges keyed by source ip
+
+    a challenge is forgotten ttl seconds after it was sent, a source
+    has at most max_per_source of them and the table at most
+    max_entries, the oldest ones make room.  expiry is lazy, it happens
+    whenever the table is looked up or added to.
+    """
+    def __init__(self, ttl=60.0, max_entries=4096, max_per_source=4, clock=time.time):
+        self.ttl=ttl
+        self.max_entries=max_entries
+        self.max_per_source=max(1, max_per_source)
+        self._clock=clock
+        # (ip, serial) -> (challenge, deadline) in the order they were sent
+        self._d=OrderedDict()
+        # ip -> its keys in _d, oldest first
+        self._by_ip={}
+        self._serial=0
+        self.expired=0
+        self.evicted=0
+        self.accepted=0
+        self.rejected=0
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, ip):
+        self.expire()
+        return ip in self._by_ip
+
+    def add(self, ip, challenge):
+        """
+        challenge is a tuple whose first item is the expected answer
+        """
+        self.expire()
+        keys=self._by_ip.get(ip, ())
+        while len(keys)>=self.max_per_source:
+            self._drop(keys[0])
+            self.evicted+=1
+            keys=self._by_ip.get(ip, ())
+        self._serial+=1
+        key=(ip, self._serial)
+        self._d[key]=(challenge, self._clock()+self.ttl)
+        self._by_ip.setdefault(ip, []).append(key)
+        while len(self._d)>self.max_entries:
+            self._drop(next(iter(self._d)))
+            self.evicted+=1
+
+    def answer(self, ip, d):
+        """
+        returns the challenge of ip that d answers and forgets it, on a
+        wrong answer every challenge of ip is forgotten and None returned
+        """
+        self.expire()
+        keys=self._by_ip.get(ip, ())
+        for key in keys:
+            if self._d[key][0][0]==d:
+                self.accepted+=1
+                return self._drop(key)
+        for key in list(keys): self._drop(key)
+        self.rejected+=1
+        return None
+
+    def expire(self, now=None):
+        if now is None: now=self._clock()
+        while self._d:
+            key=next(iter(self._d))
+            if self._d[key][1]>now: break
+            self._drop(key)
+            self.expired+=1
+
+    def stats(self):
+        return {'entries': len(self._d), 'sources': len(self._by_ip),
+          'expired': self.expired, 'evicted': self.evicted,
+          'accepted': self.accepted, 'rejected': self.rejected}
+
+    def _drop(self, key):
+        c=self._d.pop(key)[0]
+        keys=self._by_ip[key[0]]
+        keys.remove(key)
+        if not keys: del self._by_ip[key[0]]
+        return c
+
+class TimerWheel(object):
+    """
+    calls callback(key) about delay seconds after schedule(key, delay)
+
+    one thread advances a wheel of slots buckets every tick seconds, a
+    timer further away than one turn waits its remaining turns in its
+    bucket, so scheduling and cancelling are O(1) whatever the number of
+    timers.  scheduling a key again replaces its timer.  at most
+    max_entries timers are kept, the oldest scheduled one fires early to
+    make room.
+    """
+    def __init__(self, callback, tick=1.0, slots=512, max_entries=65536, clock=time.time):
+        self.tick=tick
+        self.max_entries=max_entries
+        self._callback=callback
+        self._clock=clock
+        self._lock=Lock()
+        # slot -> {key: turns left}
+        self._slots=[{} for i in range(slots)]
+        # key -> its slot, in the order they were scheduled
+        self._where=OrderedDict()
+        self._pos=0
+        self._ticks=0
+        self._t0=clock()
+        self.fired=0
+        self.evicted=0
+        self.cancelled=0
+        t=Thread(target=self._run, name="timer-wheel")
+        t.setDaemon(True)
+        t.start()
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def schedule(self, key, delay):
+        n=len(self._slots)
+        ticks=max(1, int(math.ceil(delay/self.tick)))
+        evicted=[]
+        with self._lock:
+            self._drop(key)
+            i=(self._pos+ticks)%n
+            self._slots[i][key]=(ticks-1)//n
+            self._where[key]=i
+            while len(self._where)>self.max_entries:
+                k=next(iter(self._where))
+                self._drop(k)
+                evicted.append(k)
+            self.evicted+=len(evicted)
+        for k in evicted: self._fire(k)
+
+    def cancel(self, key):
+        """
+        returns False if key had no timer
+        """
+        with self._lock:
+            if not self._drop(key): return False
+            self.cancelled+=1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {'timers': len(self._where), 'fired': self.fired,
+              'evicted': self.evicted, 'cancelled': self.cancelled}
+
+    def advance(self):
+        """
+        moves the wheel one tick and fires the timers that are due
+        """
+        due=[]
+        with self._lock:
+            self._pos=(self._pos+1)%len(self._slots)
+            slot=self._slots[self._pos]
+            for key,turns in list(slot.items()):
+                if turns: slot[key]=turns-1
+                else:
+                    del slot[key]
+                    del self._where[key]
+                    due.append(key)
+            self.fired+=len(due)
+        for key in due: self._fire(key)
+
+    def _drop(self, key):
+        i=self._where.pop(key, None)
+        if i is None: return False
+        del self._slots[i][key]
+        return True
+
+    def _fire(self, key):
+        try: self._callback(key)
+        except Exception as e: print (" ** Error: timer for [%s] failed: %s") % (key, e)
+
+    def _run(self):
+        while True:
+            # catch up on ticks missed while sleeping late
+            due=int((self._clock()-self._t0)/self.tick)
+            while self._ticks<due:
+                self._ticks+=1
+                self.advance()
+            time.sleep(max(0.0, self._t0+(self._ticks+1)*self.tick-self._clock()))
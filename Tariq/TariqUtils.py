@@ -1,4 +1,4 @@
-import gnupg
+import os
 
 def readconf(fn, d={}):
   h=d.copy()
@@ -11,33 +11,79 @@ def readconf(fn, d={}):
     h[a[0]]=a[1]
   return h
 
+# files in a gpg home whose mtime changes when its keys do
+KEYRING_FILES=('pubring.gpg', 'pubring.kbx', 'trustdb.gpg')
+
+class KeyIndex(object):
+  """
+  email, keyid and fingerprint -> key lookups for the keyring of gpg,
+  rebuilt only when the keyring files change or on reload()
+  """
+  def __init__(self, gpg):
+    self._gpg=gpg
+    self._stamp=None
+    self._maps=({},{},{})
+
+  def _keyring_stamp(self):
+    home=self._gpg.gnupghome or os.path.expanduser('~/.gnupg')
+    stamp=[]
+    for fn in KEYRING_FILES:
+      try: stamp.append(os.stat(os.path.join(home, fn)).st_mtime)
+      except OSError: stamp.append(None)
+    return tuple(stamp)
+
+  def reload(self):
+    stamp=self._keyring_stamp()
+    by_email,by_keyid,by_fingerprint={},{},{}
+    # first key listed wins, as it did with the linear scan
+    for k in self._gpg.list_keys():
+      by_fingerprint.setdefault(k['fingerprint'],k)
+      by_keyid.setdefault(k['keyid'],k)
+      for u in k['uids']:
+        if u.endswith('>') and '<' in u: by_email.setdefault(u[u.rindex('<')+1:-1],k)
+    self._maps=(by_email,by_keyid,by_fingerprint)
+    self._stamp=stamp
+    if hasattr(self._gpg, 'keys_changed'): self._gpg.keys_changed()
+
+  def fingerprints(self):
+    if self._keyring_stamp()!=self._stamp: self.reload()
+    return list(self._maps[2])
+
+  def lookup(self, email=None, keyid=None, fingerprint=None):
+    if email==None and keyid==None and fingerprint==None: raise KeyError
+    if self._keyring_stamp()!=self._stamp: self.reload()
+    by_email,by_keyid,by_fingerprint=self._maps
+    if fingerprint!=None: return by_fingerprint[fingerprint]
+    elif keyid!=None: return by_keyid[keyid]
+    return by_email[email]
+
+_key_indexes={}
+
+def key_index(gpg):
+  """
+  the KeyIndex of gpg, one per gpg home
+  """
+  k=gpg.gnupghome
+  if k not in _key_indexes: _key_indexes[k]=KeyIndex(gpg)
+  return _key_indexes[k]
+
+def reload_keys(gpg):
+  key_index(gpg).reload()
+
 def get_fingerprint(gpg, email=None, keyid=None, fingerprint=None):
-  if email==None and keyid==None and fingerprint==None: raise KeyError
-  if fingerprint!=None:
-    # this redundant check is to make sure that finger print is in keyring
-    keys=filter(lambda k: k['fingerprint']==keyid,gpg.list_keys())
-  elif keyid!=None:
-    keys=filter(lambda k: k['keyid']==keyid,gpg.list_keys())
-  else:
-    e="<"+email+">"
-    keys=filter(
-      lambda k: any(map(lambda u: u.endswith(e) ,k['uids'])),
-      gpg.list_keys()
-    )
-  if not keys: raise KeyError
-  key=keys[0]
-  fingerprint=key['fingerprint']
-  return fingerprint
+  key=key_index(gpg).lookup(email=email, keyid=keyid, fingerprint=fingerprint)
+  return key['fingerprint']
 
 def enc(gpg, s, **kw):
   """
-  enc payload s using email or keyid or fingerprint
+  enc payload s using email or keyid or fingerprint,
+  gpg is a TariqCrypto backend
   """
   fingerprint=get_fingerprint(gpg,**kw)
-  return gpg.encrypt(s, fingerprint).data
+  return gpg.encrypt(s, fingerprint)
 
 def dec(gpg, s, **kw):
   """
-  enc payload s using email or keyid or fingerprint
+  dec payload s with the secret keys of TariqCrypto backend gpg
   """
-  return gpg.decrypt(s).data
+  return gpg.decrypt(s)
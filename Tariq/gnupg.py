@@ -49,6 +49,7 @@ except ImportError:
 import locale
 import logging
 import os
+import shlex
 import socket
 from subprocess import Popen
 from subprocess import PIPE
@@ -146,7 +147,8 @@ class GPG(object):
         if self.verbose:
             print(cmd)
         logger.debug("%s", cmd)
-        return Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        # exec gpg directly rather than through a shell
+        return Popen(shlex.split(cmd), stdin=PIPE, stdout=PIPE, stderr=PIPE)
 
     def _read_response(self, stream, result):
         # Internal method: reads all the output from GPG, taking notice